@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for detect_url_country over a synthetic URL corpus.
+
+    python benchmarks/detect_url_country.py [--urls 200000]
+"""
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from server import COUNTRY_DOMAINS, country_index, detect_url_country  # noqa: E402
+
+GENERIC_HOSTS = ["www.youtube.com", "youtu.be", "vimeo.com", "twitter.com", "www.twitch.tv",
+                 "cdn.example.org", "media.some-site.net", "a.b.c.d.e.example.com"]
+
+
+def build_corpus(size: int) -> list[str]:
+    rng = random.Random(42)
+    geo_hosts = []
+    for domains in COUNTRY_DOMAINS.values():
+        for domain in domains:
+            geo_hosts.append(domain if "." in domain else f"www.example.{domain}")
+            geo_hosts.append(f"www.{domain}" if "." in domain else f"news.example.co.{domain}")
+    hosts = geo_hosts + GENERIC_HOSTS * 4
+
+    corpus = []
+    for i in range(size):
+        host = rng.choice(hosts)
+        corpus.append(f"https://{host}/watch/{i}?ref=share&t={rng.randint(0, 9999)}")
+    return corpus
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--urls", type=int, default=200_000, help="Corpus size (default: 200000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed passes; the best is reported (default: 5)")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.urls)
+    hosts = [urlsplit(url).hostname for url in corpus]
+
+    def best_ns(func, items) -> float:
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for item in items:
+                func(item)
+            best = min(best, time.perf_counter() - start)
+        return best * 1e9 / len(items)
+
+    matched = sum(1 for url in corpus if detect_url_country(url))
+    print(f"{len(corpus)} URLs, {matched} geo-locked (best of {args.repeat}):")
+    print(f"  detect_url_country:   {best_ns(detect_url_country, corpus):.0f} ns/URL")
+    print(f"  country_index.lookup: {best_ns(country_index.lookup, hosts):.0f} ns/host")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/bin/sh
+# Network namespace tunnels for `server.py --tunnel-mode netns` (and `netns-veth`).
+#
+# Each tunnel gets its own namespace "yt-<name>" joined to the host by a veth pair
+# (10.200.<slot>.0/30) and NATed out of the host's default route. With a WireGuard
+# config, wg-quick then brings the tunnel up inside the namespace, so its routes and
+# DNS never touch the host. Run via sudo; `exec` drops back to the calling user.
+# If IPv4 forwarding was off, `up` turns it on and the last `down` turns it off again.
+#
+#   netns-tunnel.sh up <name> <slot> [wireguard-config]
+#   netns-tunnel.sh down <name> <slot>
+#   netns-tunnel.sh exec <name> <command> [args...]
+set -eu
+
+usage() {
+    echo "usage: $0 up <name> <slot> [config] | down <name> <slot> | exec <name> <command...>" >&2
+    exit 2
+}
+
+[ $# -ge 2 ] || usage
+action=$1
+name=$2
+case "$name" in
+    ""|*[!a-z0-9-]*) echo "invalid tunnel name: $name" >&2; exit 2 ;;
+esac
+ns="yt-$name"
+# Set when `up` had to enable IPv4 forwarding, so the last `down` disables it again
+forwarding_marker=/run/yt-netns-forwarding
+
+lock() {
+    # up and down of different tunnels may run at once; serialize the forwarding bookkeeping
+    exec 9>/run/yt-netns-tunnel.lock
+    flock 9
+}
+
+check_slot() {
+    case "$1" in
+        ""|*[!0-9]*) echo "invalid slot: $1" >&2; exit 2 ;;
+    esac
+    [ "$1" -le 255 ] || { echo "invalid slot: $1" >&2; exit 2; }
+}
+
+case "$action" in
+up)
+    [ $# -ge 3 ] || usage
+    slot=$3
+    check_slot "$slot"
+    config=${4:-}
+    case "$config" in
+        *[!a-z0-9-]*) echo "invalid config name: $config" >&2; exit 2 ;;
+    esac
+    host_if="ytv${slot}h"
+    ns_if="ytv${slot}n"
+    subnet="10.200.${slot}"
+
+    # Clear anything left over from a previous run
+    ip netns del "$ns" 2>/dev/null || true
+    ip link del "$host_if" 2>/dev/null || true
+
+    ip netns add "$ns"
+    ip link add "$host_if" type veth peer name "$ns_if"
+    ip link set "$ns_if" netns "$ns"
+    ip addr add "$subnet.1/30" dev "$host_if"
+    ip link set "$host_if" up
+    ip -n "$ns" addr add "$subnet.2/30" dev "$ns_if"
+    ip -n "$ns" link set lo up
+    ip -n "$ns" link set "$ns_if" up
+    ip -n "$ns" route add default via "$subnet.1"
+
+    lock
+    if [ "$(sysctl -n net.ipv4.ip_forward)" = 0 ]; then
+        touch "$forwarding_marker"
+        sysctl -qw net.ipv4.ip_forward=1
+    fi
+    flock -u 9
+    iptables -t nat -C POSTROUTING -s "$subnet.0/30" -j MASQUERADE 2>/dev/null ||
+        iptables -t nat -A POSTROUTING -s "$subnet.0/30" -j MASQUERADE
+
+    # `ip netns exec` bind-mounts this over /etc/resolv.conf. A local stub resolver
+    # (e.g. systemd-resolved on 127.0.0.53) isn't reachable from the namespace.
+    mkdir -p "/etc/netns/$ns"
+    resolv=/etc/resolv.conf
+    if grep -q '^nameserver 127\.' "$resolv" && [ -f /run/systemd/resolve/resolv.conf ]; then
+        resolv=/run/systemd/resolve/resolv.conf
+    fi
+    cp "$resolv" "/etc/netns/$ns/resolv.conf"
+
+    if [ -n "$config" ]; then
+        # Use the config's DNS servers inside the namespace instead of letting
+        # wg-quick hand them to the host's resolvconf
+        tmp=$(mktemp -d)
+        trap 'rm -rf "$tmp"' EXIT
+        grep -v '^[[:space:]]*DNS[[:space:]]*=' "/etc/wireguard/$config.conf" > "$tmp/$config.conf"
+        dns=$(sed -n 's/^[[:space:]]*DNS[[:space:]]*=[[:space:]]*//p' "/etc/wireguard/$config.conf" | tr ',' ' ')
+        : > "$tmp/resolv.conf"
+        for entry in $dns; do
+            case "$entry" in
+                *[!0-9a-fA-F:.]*) ;;
+                *) echo "nameserver $entry" >> "$tmp/resolv.conf" ;;
+            esac
+        done
+        if [ -s "$tmp/resolv.conf" ]; then
+            cp "$tmp/resolv.conf" "/etc/netns/$ns/resolv.conf"
+        fi
+        ip netns exec "$ns" wg-quick up "$tmp/$config.conf"
+    fi
+    ;;
+down)
+    [ $# -ge 3 ] || usage
+    slot=$3
+    check_slot "$slot"
+    # Deleting the namespace also removes the WireGuard interface and veth pair inside it
+    ip netns del "$ns" 2>/dev/null || true
+    ip link del "ytv${slot}h" 2>/dev/null || true
+    iptables -t nat -D POSTROUTING -s "10.200.${slot}.0/30" -j MASQUERADE 2>/dev/null || true
+    rm -rf "/etc/netns/$ns"
+    lock
+    if [ -e "$forwarding_marker" ] && ! ip netns list | grep -q '^yt-'; then
+        sysctl -qw net.ipv4.ip_forward=0
+        rm -f "$forwarding_marker"
+    fi
+    ;;
+exec)
+    [ $# -ge 3 ] || usage
+    shift 2
+    uid=${SUDO_UID:-0}
+    # sudo leaves HOME pointing at root's; yt-dlp keeps its cache and config under it
+    home=$(getent passwd "$uid" | cut -d: -f6)
+    exec ip netns exec "$ns" setpriv --reuid="$uid" --regid="${SUDO_GID:-0}" --init-groups -- \
+        env HOME="${home:-/}" "$@"
+    ;;
+*)
+    usage
+    ;;
+esac
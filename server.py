@@ -5,26 +5,61 @@ Detects video region and selects appropriate WireGuard config from any country.
 Includes download queue for sequential processing on resource-constrained devices.
 """
 import asyncio
+import hashlib
+import heapq
 import json
+import math
+import multiprocessing
+import random
 import re
+import shutil
+import signal
+import sqlite3
 import subprocess
-from collections import deque
-from dataclasses import dataclass, asdict
-from datetime import datetime
+import sys
+import threading
+import time
+import urllib.request
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, asdict, field, fields
+from datetime import datetime, timedelta
 from enum import Enum
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
-from urllib.parse import urlparse
-import threading
+from typing import AsyncIterator, Callable, Collection, Optional, Sequence
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
 
 from fastmcp import FastMCP
 
+try:
+    import tomllib
+except ImportError:  # Python 3.10: JSON rule files only
+    tomllib = None
+
 # Initialize MCP server
 mcp = FastMCP("yt-dlp-vpn")
 
 # Configuration
 WIREGUARD_DIR = Path("/etc/wireguard")
 DEFAULT_DOWNLOAD_DIR = Path.home() / "Downloads"
+DEFAULT_STATE_DB = Path.home() / ".local" / "share" / "yt-api" / "jobs.db"
+DEFAULT_METADATA_CACHE_DIR = Path.home() / ".cache" / "yt-api" / "info"
+DEFAULT_DOWNLOAD_ARCHIVE = Path.home() / ".local" / "share" / "yt-api" / "archive.txt"
+# Lines of yt-dlp output kept for the job result; the rest is discarded as it streams
+OUTPUT_TAIL_LINES = 50
+
+# yt-dlp prints one of these per progress update with --newline (NA for unknown fields).
+# The partial file's name comes last since it may contain spaces.
+PROGRESS_PREFIX = "[ytdlp-progress]"
+PROGRESS_FIELDS = ["downloaded_bytes", "total_bytes", "total_bytes_estimate", "speed", "eta",
+                   "fragment_index", "fragment_count"]
+PROGRESS_TEMPLATE = ("download:" + PROGRESS_PREFIX + " " + " ".join(f"%(progress.{f})s" for f in PROGRESS_FIELDS)
+                     + " %(progress.tmpfilename)s")
+# Longest output line read whole. --dump-json prints a video's full info on one line,
+# which for YouTube runs to hundreds of KB, well past asyncio's 64 KiB default.
+JSON_LINE_LIMIT = 64 * 1024 * 1024
 
 
 # Queue management
@@ -49,113 +84,979 @@ class DownloadJob:
     completed_at: Optional[str] = None
     error: Optional[str] = None
     result: Optional[str] = None
+    country: Optional[str] = None
+    skipped: int = 0
+    # Latest progress reported by yt-dlp
+    downloaded_bytes: Optional[int] = None
+    total_bytes: Optional[int] = None
+    speed: Optional[float] = None
+    eta: Optional[int] = None
+    fragment_index: Optional[int] = None
+    fragment_count: Optional[int] = None
+    # Partial file of an unfinished download, and its size when the last attempt
+    # stopped; the next attempt continues from it
+    part_file: Optional[str] = None
+    part_bytes: Optional[int] = None
+    resumes: int = 0
+    # Failed attempts so far, the configs that geo/network failures went through,
+    # and when (epoch seconds) a failed job may be tried again
+    attempts: int = 0
+    failed_configs: list[str] = field(default_factory=list)
+    retry_at: Optional[float] = None
+    # The video's download archive line ("<extractor> <id>"), when the URL gives it away
+    archive_id: Optional[str] = None
+    # Higher priorities run first; among equals, the earliest deadline (epoch seconds)
+    priority: int = 0
+    deadline: Optional[float] = None
 
 
-class DownloadQueue:
+@dataclass
+class PlaylistExpansion:
+    """A playlist being listed, with each entry queued as its own job when found (see DownloadQueue.expand)."""
+    id: int
+    url: str
+    status: str = "listing"  # listing, done or failed
+    job_ids: list[int] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+class JobStore:
+    """
+    SQLite job store so the queue survives restarts.
+
+    Runs in WAL mode with synchronous=NORMAL, so each write is a single-row upsert
+    that doesn't wait on an fsync. Only job state changes are written; status reads
+    are served from DownloadQueue's in-memory structures.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, status TEXT NOT NULL, data TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS endpoints (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+
+    def save(self, job: DownloadJob):
+        self.db.execute("INSERT OR REPLACE INTO jobs (id, status, data) VALUES (?, ?, ?)", self._row(job))
+
+    def save_many(self, jobs: list[DownloadJob]):
+        """Save several jobs in one transaction, so a batch costs one commit rather than one per job."""
+        self.db.execute("BEGIN")
+        try:
+            self.db.executemany("INSERT OR REPLACE INTO jobs (id, status, data) VALUES (?, ?, ?)",
+                                [self._row(job) for job in jobs])
+        except sqlite3.Error:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def load_unfinished(self) -> list[DownloadJob]:
+        """Jobs that were queued or downloading when the server stopped, oldest first."""
+        rows = self.db.execute(
+            "SELECT data FROM jobs WHERE status IN (?, ?) ORDER BY id",
+            (DownloadStatus.QUEUED.value, DownloadStatus.DOWNLOADING.value)
+        )
+        return [self._load(data) for (data,) in rows]
+
+    def load_history(self, limit: int) -> list[DownloadJob]:
+        """The most recently finished jobs, oldest first."""
+        rows = self.db.execute(
+            "SELECT data FROM jobs WHERE status IN (?, ?) ORDER BY id DESC LIMIT ?",
+            (DownloadStatus.COMPLETED.value, DownloadStatus.FAILED.value, limit)
+        )
+        return [self._load(data) for (data,) in rows][::-1]
+
+    def load(self, job_id: int) -> Optional[DownloadJob]:
+        row = self.db.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._load(row[0]) if row else None
+
+    def max_id(self) -> int:
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM jobs").fetchone()[0]
+
+    def load_endpoints(self) -> dict[str, dict]:
+        return {name: json.loads(data) for name, data in self.db.execute("SELECT name, data FROM endpoints")}
+
+    def save_endpoint(self, name: str, data: dict):
+        self.db.execute(
+            "INSERT OR REPLACE INTO endpoints (name, data) VALUES (?, ?)",
+            (name, json.dumps(data))
+        )
+
+    def delete_finished(self):
+        self.db.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?)",
+            (DownloadStatus.COMPLETED.value, DownloadStatus.FAILED.value)
+        )
+
+    @staticmethod
+    def _row(job: DownloadJob) -> tuple[int, str, str]:
+        data = asdict(job)
+        data["status"] = job.status.value
+        return job.id, job.status.value, json.dumps(data)
+
+    @staticmethod
+    def _load(data: str) -> DownloadJob:
+        values = json.loads(data)
+        # Ignore columns from other versions of DownloadJob
+        known = {f.name for f in fields(DownloadJob)}
+        values = {k: v for k, v in values.items() if k in known}
+        values["status"] = DownloadStatus(values["status"])
+        return DownloadJob(**values)
+
+
+class DownloadArchive:
+    """
+    Videos already downloaded, in yt-dlp's --download-archive format: one
+    "<extractor> <id>" line per video. yt-dlp is handed the same file, appends each
+    video it finishes and skips ones already listed. The lines are kept in a set,
+    topped up with whatever was appended since the last read, so a lookup doesn't
+    read the whole file.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: set[str] = set()
+        self.offset = 0
+        self.inode = None
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.refresh()
+
+    def __contains__(self, entry: Optional[str]) -> bool:
+        return entry in self.entries
+
+    def refresh(self):
+        """Read lines appended since the last call, or the whole file if it was replaced or cut short."""
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            self.entries.clear()
+            self.offset = 0
+            return
+        if stat.st_ino != self.inode or stat.st_size < self.offset:
+            self.entries.clear()
+            self.offset = 0
+            self.inode = stat.st_ino
+        if stat.st_size == self.offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # Leave a line that is still being written for the next read
+        end = data.rfind(b"\n") + 1
+        self.entries.update(line.strip() for line in data[:end].decode(errors="replace").splitlines() if line.strip())
+        self.offset += end
+
+    def add(self, entry: str):
+        self.refresh()
+        if entry not in self.entries:
+            with open(self.path, "a") as f:
+                f.write(entry + "\n")
+            self.refresh()
+
+
+class JobQueue:
+    """
+    Queued jobs in priority order: highest priority first, then earliest deadline
+    (jobs with one ahead of jobs without), then lowest id, so a job that is queued
+    again keeps its place.
+
+    Each country's jobs (None for direct ones) are in a heap of their own, since
+    the scheduler only ever starts the front job of a country: every job of a
+    country waits on the same tunnel. Jobs waiting out a retry backoff are in a
+    separate heap by retry_at until they are due. Push and pop are O(log n); a
+    removed job's heap entry is marked dead and dropped once it reaches the top.
+    """
+
     def __init__(self):
-        self.queue: deque[DownloadJob] = deque()
-        self.history: list[DownloadJob] = []
-        self.current_job: Optional[DownloadJob] = None
+        self.heaps: dict[Optional[str], list[list]] = {}
+        self.delayed: list[list] = []
+        # Live heap entry of each queued job: [sort key, job], job None once removed
+        self.entries: dict[int, list] = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        """Jobs in the order they would start if nothing were waiting."""
+        return iter(sorted((entry[1] for entry in self.entries.values()), key=self.sort_key))
+
+    def __contains__(self, job: DownloadJob) -> bool:
+        return job.id in self.entries
+
+    def first(self, n: int) -> list[DownloadJob]:
+        """The first `n` jobs in __iter__'s order, without sorting the rest."""
+        return heapq.nsmallest(n, (entry[1] for entry in self.entries.values()), key=self.sort_key)
+
+    @staticmethod
+    def sort_key(job: DownloadJob) -> tuple:
+        return -job.priority, job.deadline if job.deadline is not None else math.inf, job.id
+
+    def push(self, job: DownloadJob):
+        if job.retry_at and job.retry_at > time.time():
+            entry = [(job.retry_at, job.id), job]
+            heapq.heappush(self.delayed, entry)
+        else:
+            entry = [self.sort_key(job), job]
+            heapq.heappush(self.heaps.setdefault(job.country, []), entry)
+        self.entries[job.id] = entry
+
+    def remove(self, job: DownloadJob):
+        self.entries.pop(job.id)[1] = None
+
+    def fronts(self) -> list[DownloadJob]:
+        """The first job of each country that can start now, in priority order."""
+        now = time.time()
+        while self.delayed and self.delayed[0][0][0] <= now:
+            job = heapq.heappop(self.delayed)[1]
+            if job is not None:
+                self.push(job)
+
+        fronts = []
+        for country, heap in list(self.heaps.items()):
+            while heap and heap[0][1] is None:
+                heapq.heappop(heap)
+            if heap:
+                fronts.append(heap[0])
+            else:
+                del self.heaps[country]
+        return [entry[1] for entry in sorted(fronts)]
+
+    def pop(self, job: DownloadJob):
+        """Remove `job`, which must be one of fronts()."""
+        heapq.heappop(self.heaps[job.country])
+        del self.entries[job.id]
+
+
+RATE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+
+def parse_rate(value: str) -> Optional[float]:
+    """
+    Bytes/s for a rate in yt-dlp's --limit-rate syntax ('500K', '4.2M'), None for
+    'unlimited' and 0 for 'pause'. Raises ValueError.
+    """
+    value = value.strip().lower()
+    if value in ("unlimited", "none"):
+        return None
+    if value == "pause":
+        return 0.0
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([kmg]?)i?b?", value)
+    if not match or float(match[1]) <= 0:
+        raise ValueError(f"invalid rate: {value!r}")
+    return float(match[1]) * RATE_UNITS[match[2]]
+
+
+@dataclass
+class DownloadWindow:
+    """A daily time window with its own download rate (see BandwidthSchedule)."""
+    start: int  # minutes after midnight
+    end: int
+    rate: Optional[float]
+
+    def covers(self, minute: int) -> bool:
+        if self.start < self.end:
+            return self.start <= minute < self.end
+        # Crosses midnight
+        return minute >= self.start or minute < self.end
+
+
+def parse_window(value: str) -> DownloadWindow:
+    """A window given as 'HH:MM-HH:MM=RATE', RATE as for parse_rate. Raises ValueError."""
+    match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=(.+)", value)
+    if not match:
+        raise ValueError(f"invalid window: {value!r}")
+    start_hour, start_minute, end_hour, end_minute = (int(match[i]) for i in range(1, 5))
+    if max(start_hour, end_hour) > 23 or max(start_minute, end_minute) > 59:
+        raise ValueError(f"invalid window: {value!r}")
+    start = start_hour * 60 + start_minute
+    end = end_hour * 60 + end_minute
+    if start == end:
+        raise ValueError(f"empty window: {value!r}")
+    return DownloadWindow(start, end, parse_rate(match[5]))
+
+
+class BandwidthSchedule:
+    """
+    How fast the queue may download at a given time: `limit` bytes/s (None for no
+    limit), unless one of `windows` covers the time of day, in which case the first
+    one that does sets the rate. A rate of 0 pauses downloading.
+    """
+
+    def __init__(self, limit: Optional[float] = None, windows: Sequence[DownloadWindow] = ()):
+        self.limit = limit
+        self.windows = list(windows)
+
+    def rate_at(self, when: datetime) -> Optional[float]:
+        minute = when.hour * 60 + when.minute
+        for window in self.windows:
+            if window.covers(minute):
+                return window.rate
+        return self.limit
+
+    def current(self) -> tuple[Optional[float], Optional[float]]:
+        """(the rate now, when in epoch seconds it next changes or None if it never does)."""
+        now = datetime.now()
+        rate = self.rate_at(now)
+        if not self.windows:
+            return rate, None
+        minute = now.hour * 60 + now.minute
+        base = now.replace(second=0, microsecond=0)
+        # Minutes until each window boundary; one at this very minute is a day away
+        offsets = sorted({(edge - minute) % 1440 or 1440 for window in self.windows
+                          for edge in (window.start, window.end)})
+        for offset in offsets:
+            when = base + timedelta(minutes=offset)
+            if self.rate_at(when) != rate:
+                return rate, when.timestamp()
+        return rate, None
+
+
+class DownloadQueue:
+    """
+    Download queue processed by a pool of asyncio worker tasks.
+
+    Direct (no VPN) jobs run concurrently up to `workers` at a time. VPN jobs only
+    run concurrently with other jobs for the same country, since they share the
+    single tunnel; a VPN job for another country waits for that tunnel to drain.
+
+    Scheduling modes:
+        fifo: jobs start in the order they were added (direct jobs may overtake
+            a VPN job that is waiting for the tunnel)
+        country: jobs for the country whose tunnel is in use or still up
+            (see TunnelManager) run first, so a mixed queue only brings each
+            tunnel up once per batch. A job may be passed over at most max_skips
+            times before it is run regardless.
+
+    A failed job is retried up to `max_attempts` attempts in total, after an
+    exponentially growing delay (`retry_backoff` seconds doubling per attempt, up
+    to `max_backoff`, with jitter). Geo-blocks and network errors are retried
+    through a different config of the same country when there is one; permanent
+    errors such as a 404 are not retried.
+
+    Playlists go through an expansion stage first (see expand): entries are queued
+    as they are listed, so the first downloads start while the rest are still
+    being found.
+
+    A URL that is already queued or downloading with the same options isn't queued
+    again; the request is coalesced onto the existing job. URLs are compared by
+    their yt-dlp extractor and video id where the URL gives it away (see archive_id),
+    otherwise by canonical_url. With a download `archive`, videos already in it are
+    recorded as completed straight away instead of being queued.
+
+    Jobs start in priority order (see JobQueue) rather than strictly in the order
+    they were added; with the default priority and no deadlines that is the same.
+
+    `bandwidth` sets the total download rate, split evenly between the workers so
+    that it holds however many run at once. No job starts while it is paused. When
+    the rate changes (see BandwidthSchedule), running downloads are stopped and
+    queued again at the front, to continue from their partial files at the new rate.
+
+    Only the last `history_limit` finished jobs are kept in memory; older ones are
+    still available from the job store. `jobs` indexes every in-memory job by id.
+    """
+
+    def __init__(self, schedule: str = "fifo", max_skips: int = 5, workers: int = 1,
+                 history_limit: int = 100, max_attempts: int = 3, retry_backoff: float = 30.0,
+                 max_backoff: float = 600.0):
+        self.queue = JobQueue()
+        self.history: deque[DownloadJob] = deque(maxlen=history_limit)
+        self.jobs: dict[int, DownloadJob] = {}
+        self.active: dict[int, DownloadJob] = {}
+        self.vpn_running: Counter[str] = Counter()
         self.next_id = 1
-        self.lock = threading.Lock()
-        self.worker_thread: Optional[threading.Thread] = None
+        # Signalled when a job is added or finishes, so idle workers block without polling.
+        # Everything runs on the server's event loop, so the condition's lock is only
+        # needed around awaits.
+        self.job_event = asyncio.Condition()
+        self.worker_tasks: list[asyncio.Task] = []
         self.running = False
+        self.schedule = schedule
+        self.max_skips = max_skips
+        self.workers = workers
+        # Tunnels run in separate namespaces (--tunnel-mode netns), so VPN jobs for
+        # different countries can run at the same time
+        self.isolated_tunnels = False
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        # Sleeps that wake the workers when a retry's backoff ends
+        self.wake_tasks: set[asyncio.Task] = set()
+        self.expansions: dict[int, PlaylistExpansion] = {}
+        self.next_expansion_id = 1
+        self.expansion_tasks: set[asyncio.Task] = set()
+        # Queued and running jobs by duplicate_key
+        self.pending: dict[tuple, DownloadJob] = {}
+        self.archive: Optional[DownloadArchive] = None
+        self.bandwidth = BandwidthSchedule()
+        # When the current pause ends, once the workers have been told to wake then
+        self.paused_until: Optional[float] = None
+        self.store: Optional[JobStore] = None
+
+    def attach_store(self, store: JobStore):
+        """
+        Persist jobs to store and recover its state. Jobs that were downloading when
+        the server stopped are queued again ahead of anything added since, continuing
+        their partial files.
+        """
+        self.store = store
+        recovered = store.load_unfinished()
+        for job in recovered:
+            if job.status == DownloadStatus.DOWNLOADING:
+                job.status = DownloadStatus.QUEUED
+                job.started_at = None
+                if job.part_file:
+                    job.part_bytes = partial_size(job)
+                    job.resumes += 1
+                store.save(job)
+        for job in recovered:
+            self.queue.push(job)
+        self.jobs.update((job.id, job) for job in recovered)
+        self.pending.update((self.duplicate_key(job), job) for job in recovered)
+        newer = list(self.history)
+        self.history.clear()
+        for job in store.load_history(limit=self.history.maxlen) + newer:
+            self._add_history(job)
+        self.next_id = max(self.next_id, store.max_id() + 1)
+
+    def start(self):
+        """Start the workers (called once the event loop is running) to resume recovered jobs."""
+        self._ensure_worker()
+        for job in self.queue:
+            if job.retry_at:
+                self._wake_at(job.retry_at)
+
+    def set_history_limit(self, limit: int):
+        self.history = deque(self.history, maxlen=limit)
+        self._reindex()
+
+    def _persist(self, job: DownloadJob):
+        if self.store:
+            self.store.save(job)
+
+    def _add_history(self, job: DownloadJob):
+        """Append a finished job, evicting the oldest from memory once the buffer is full."""
+        if len(self.history) == self.history.maxlen:
+            evicted = self.history.popleft()
+            self.jobs.pop(evicted.id, None)
+        self.history.append(job)
+        self.jobs[job.id] = job
+
+    def _reindex(self):
+        self.jobs = {job.id: job for job in (*self.queue, *self.active.values(), *self.history)}
+
+    @staticmethod
+    def duplicate_key(job: DownloadJob) -> tuple:
+        """Jobs with the same key would download the same file."""
+        return job.archive_id or canonical_url(job.url), job.output_dir, job.format_spec
+
+    async def add_many(self, urls: list[str], auto_vpn: bool = True, preferred_city: Optional[str] = None,
+                       output_dir: Optional[str] = None, format_spec: str = "best", priority: int = 0,
+                       deadline: Optional[float] = None) -> tuple[list[DownloadJob], list[DownloadJob]]:
+        """
+        Queue several URLs with the same options. New jobs get consecutive ids, are
+        added under one acquisition of the queue lock and persisted in one transaction.
+        Returns (new jobs, existing jobs that duplicate URLs were coalesced onto). New
+        jobs for videos in the download archive are already completed. A queued job
+        that a duplicate is coalesced onto takes the more urgent priority and deadline.
+        """
+        countries = [detect_url_country(url) for url in urls] if auto_vpn else [None] * len(urls)
+        # Matching a URL against every extractor takes a few milliseconds, and the
+        # first call imports them all
+        archive_ids = await asyncio.to_thread(lambda: [archive_id(url) for url in urls])
+        added_at = datetime.now().isoformat()
+        async with self.job_event:
+            if self.archive:
+                self.archive.refresh()
+            added = []
+            existing = []
+            queued = []
+            for url, country, video_id in zip(urls, countries, archive_ids):
+                job = DownloadJob(
+                    id=self.next_id,
+                    url=url,
+                    status=DownloadStatus.QUEUED,
+                    auto_vpn=auto_vpn,
+                    preferred_city=preferred_city,
+                    output_dir=output_dir,
+                    format_spec=format_spec,
+                    added_at=added_at,
+                    country=country,
+                    archive_id=video_id,
+                    priority=priority,
+                    deadline=deadline
+                )
+                key = self.duplicate_key(job)
+                if key in self.pending:
+                    duplicate = self.pending[key]
+                    if duplicate not in existing:
+                        existing.append(duplicate)
+                        if duplicate in self.queue:
+                            self._reprioritize(
+                                duplicate, max(priority, duplicate.priority),
+                                min((d for d in (deadline, duplicate.deadline) if d is not None), default=None)
+                            )
+                    continue
+                self.next_id += 1
+                added.append(job)
+                if self.archive and video_id in self.archive:
+                    job.status = DownloadStatus.COMPLETED
+                    job.completed_at = added_at
+                    job.result = f"Already downloaded: {video_id} is in the download archive"
+                    self._add_history(job)
+                else:
+                    queued.append(job)
+                    self.pending[key] = job
+
+            for job in queued:
+                self.queue.push(job)
+            self.jobs.update((job.id, job) for job in queued)
+            if self.store and added:
+                self.store.save_many(added)
+            if queued:
+                self._ensure_worker()
+                self.job_event.notify(len(queued))
+            return added, existing
+
+    def expand(self, url: str, auto_vpn: bool = True, preferred_city: Optional[str] = None,
+               output_dir: Optional[str] = None, format_spec: str = "best", priority: int = 0,
+               deadline: Optional[float] = None) -> PlaylistExpansion:
+        """
+        List a playlist in the background, queuing each entry as a job with these options.
+        A single-video URL just becomes one job.
+        """
+        expansion = PlaylistExpansion(id=self.next_expansion_id, url=url)
+        self.next_expansion_id += 1
+        self.expansions[expansion.id] = expansion
+        # Keep the last 100 around for status
+        for old in list(self.expansions.values())[:-100]:
+            if old.status != "listing":
+                del self.expansions[old.id]
+        task = asyncio.create_task(self._expand(expansion, auto_vpn, preferred_city, output_dir, format_spec,
+                                                priority, deadline))
+        self.expansion_tasks.add(task)
+        task.add_done_callback(self.expansion_tasks.discard)
+        return expansion
+
+    async def _expand(self, expansion: PlaylistExpansion, *options):
+        found: asyncio.Queue[Optional[str]] = asyncio.Queue()
+
+        async def list_entries():
+            try:
+                async for entry_url in engine.iter_playlist(expansion.url, idle_timeout=120):
+                    found.put_nowait(entry_url)
+            finally:
+                found.put_nowait(None)
+
+        lister = asyncio.create_task(list_entries())
+        # Ids already recorded; a duplicate entry is coalesced onto a job seen before
+        seen: set[int] = set()
+        listing = True
+        while listing:
+            # Queue whatever has been listed since the last pass in one go; yt-dlp
+            # tends to list a page of entries at a time
+            chunk = [await found.get()]
+            while not found.empty() and len(chunk) < 500:
+                chunk.append(found.get_nowait())
+            if chunk[-1] is None:
+                chunk.pop()
+                listing = False
+            if chunk:
+                added, existing = await self.add_many(chunk, *options)
+                for job in added + existing:
+                    if job.id not in seen:
+                        seen.add(job.id)
+                        expansion.job_ids.append(job.id)
 
-    def add(self, url: str, auto_vpn: bool = True, preferred_city: Optional[str] = None,
-            output_dir: Optional[str] = None, format_spec: str = "best") -> DownloadJob:
-        with self.lock:
-            job = DownloadJob(
-                id=self.next_id,
-                url=url,
-                status=DownloadStatus.QUEUED,
-                auto_vpn=auto_vpn,
-                preferred_city=preferred_city,
-                output_dir=output_dir,
-                format_spec=format_spec,
-                added_at=datetime.now().isoformat()
-            )
-            self.next_id += 1
-            self.queue.append(job)
-            self._ensure_worker()
-            return job
+        try:
+            await lister
+            expansion.status = "done"
+        except subprocess.TimeoutExpired:
+            expansion.status = "failed"
+            expansion.error = "Timeout listing playlist"
+        except Exception as e:
+            expansion.status = "failed"
+            # yt-dlp's log can come along with the error; its last line is the cause
+            expansion.error = (str(e).strip().splitlines() or [type(e).__name__])[-1]
 
     def _ensure_worker(self):
         if not self.running:
             self.running = True
-            self.worker_thread = threading.Thread(target=self._worker, daemon=True)
-            self.worker_thread.start()
+            for _ in range(self.workers):
+                self.worker_tasks.append(asyncio.create_task(self._worker()))
 
-    def _worker(self):
+    async def _worker(self):
         while self.running:
-            job = None
-            with self.lock:
-                if self.queue:
-                    job = self.queue.popleft()
-                    self.current_job = job
-
-            if job:
-                self._process_job(job)
-                with self.lock:
-                    self.history.append(job)
-                    self.current_job = None
-            else:
-                # No jobs, sleep briefly
-                threading.Event().wait(1)
+            async with self.job_event:
+                job = await self.job_event.wait_for(self._next_job)
+                self.active[job.id] = job
+                if job.country:
+                    self.vpn_running[job.country] += 1
+
+            finished = await self._process_job(job)
+            async with self.job_event:
+                if finished:
+                    self._add_history(job)
+                else:
+                    # Interrupted or retrying; it keeps its place ahead of later jobs
+                    self.queue.push(job)
+                del self.active[job.id]
+                if job.country:
+                    self.vpn_running[job.country] -= 1
+                    if not self.vpn_running[job.country]:
+                        del self.vpn_running[job.country]
+                # A finished VPN job may unblock jobs waiting for its tunnel to drain
+                self.job_event.notify_all()
+
+    def _next_job(self) -> Optional[DownloadJob]:
+        """Remove and return the next job that can start now, or None."""
+        rate, change_at = self.bandwidth.current()
+        if rate == 0:
+            if change_at and change_at != self.paused_until:
+                self.paused_until = change_at
+                self._wake_at(change_at)
+            return None
+
+        # Only each country's front job is a candidate: the jobs behind it are waiting
+        # for the same tunnel. Jobs waiting out a retry backoff are left out until it ends.
+        fronts = self.queue.fronts()
+        if not fronts:
+            return None
+
+        candidates = list(fronts)
+        if self.schedule == "country":
+            starved = next((j for j in candidates if j.skipped >= self.max_skips), None)
+            batch_country = next(iter(self.vpn_running), None) or tunnels.country
+            if starved:
+                candidates.remove(starved)
+                candidates.insert(0, starved)
+            elif batch_country:
+                candidates.sort(key=lambda j: j.country != batch_country)
+
+        chosen = None
+        vpn_blocked = False
+        for job in candidates:
+            if not job.country:
+                chosen = job
+                break
+            if vpn_blocked:
+                continue
+            if self.isolated_tunnels or not self.vpn_running or (
+                    # A retry avoiding the shared tunnel's config waits for it to drain too
+                    job.country in self.vpn_running and tunnels.interface not in job.failed_configs):
+                chosen = job
+                break
+            # Waiting for the tunnel in use to drain; don't let later VPN jobs jump it
+            vpn_blocked = True
+
+        if chosen is None:
+            return None
+
+        for job in fronts:
+            if job is chosen:
+                break
+            job.skipped += 1
+
+        self.queue.pop(chosen)
+        chosen.retry_at = None
+        return chosen
+
+    async def _process_job(self, job: DownloadJob) -> bool:
+        """
+        Run a job. Returns False if it should be queued again: interrupted after
+        making progress (to continue its partial file) or failed with a retry left.
+        """
+        rate, change_at = self.bandwidth.current()
+        if rate == 0:
+            # Paused since it was picked
+            self._requeue(job)
+            return False
 
-    def _process_job(self, job: DownloadJob):
         job.status = DownloadStatus.DOWNLOADING
         job.started_at = datetime.now().isoformat()
+        self._persist(job)
 
         try:
-            result = _download_video_internal(
+            result = await _download_video_internal(
                 job.url,
                 job.auto_vpn,
                 job.preferred_city,
                 job.output_dir,
-                job.format_spec
+                job.format_spec,
+                on_progress=lambda progress: self._record_progress(job, progress),
+                resume=job.part_file is not None,
+                exclude_configs=job.failed_configs,
+                download_archive=self.archive.path if self.archive else None,
+                rate_limit=rate / self.workers if rate else None,
+                stop_after=change_at - time.time() if change_at else None
             )
+            if self.archive:
+                # yt-dlp has recorded the video itself. The id from the URL is added too
+                # in case it differs, e.g. a URL that redirects to another site.
+                if job.archive_id:
+                    self.archive.add(job.archive_id)
+                else:
+                    self.archive.refresh()
             job.status = DownloadStatus.COMPLETED
             job.result = result
+            job.part_file = None
+            job.part_bytes = None
+            job.error = None
+        except DownloadFailed as e:
+            job.result = e.details
+            job.error = str(e)
+            if e.kind == "schedule":
+                # Continue at the new rate, or once the pause is over
+                if job.part_file:
+                    job.part_bytes = partial_size(job)
+                    job.resumes += 1
+                self._requeue(job)
+                return False
+            if isinstance(e, DownloadInterrupted):
+                part_bytes = partial_size(job)
+                if part_bytes > (job.part_bytes or 0):
+                    # Made progress: continue right away without using up an attempt
+                    job.part_bytes = part_bytes
+                    job.resumes += 1
+                    self._requeue(job)
+                    return False
+            if self._retry(job, e):
+                return False
+            job.status = DownloadStatus.FAILED
         except Exception as e:
             job.status = DownloadStatus.FAILED
             job.error = str(e)
-        finally:
-            job.completed_at = datetime.now().isoformat()
 
-    def get_status(self) -> dict:
-        with self.lock:
-            return {
-                "current": asdict(self.current_job) if self.current_job else None,
-                "queued": [asdict(j) for j in self.queue],
-                "recent_history": [asdict(j) for j in self.history[-10:]]
-            }
+        job.completed_at = datetime.now().isoformat()
+        self.pending.pop(self.duplicate_key(job), None)
+        self._persist(job)
+        return True
+
+    def _retry(self, job: DownloadJob, error: "DownloadFailed") -> bool:
+        """Schedule another attempt at a failed job if the retry policy allows one."""
+        job.attempts += 1
+        if error.kind == "permanent" or job.attempts >= self.max_attempts:
+            return False
+        if error.kind in ("geo", "network") and error.config and error.config.stem not in job.failed_configs:
+            # Fail over: select_best_config avoids this config for the next attempt
+            job.failed_configs.append(error.config.stem)
+
+        # Exponential backoff with jitter, so jobs that failed together don't retry in lockstep
+        delay = min(self.max_backoff, self.retry_backoff * 2 ** (job.attempts - 1))
+        job.retry_at = time.time() + random.uniform(delay / 2, delay)
+        self._requeue(job)
+        self._wake_at(job.retry_at)
+        return True
+
+    def _requeue(self, job: DownloadJob):
+        job.status = DownloadStatus.QUEUED
+        job.started_at = None
+        self._persist(job)
+
+    def _wake_at(self, when: float):
+        async def wake():
+            await asyncio.sleep(max(0.0, when - time.time()))
+            async with self.job_event:
+                self.job_event.notify_all()
+
+        task = asyncio.create_task(wake())
+        self.wake_tasks.add(task)
+        task.add_done_callback(self.wake_tasks.discard)
+
+    def _record_progress(self, job: DownloadJob, progress: dict):
+        new_part_file = progress.get("part_file") not in (None, job.part_file)
+        for field, value in progress.items():
+            if value is not None:
+                setattr(job, field, value)
+        if new_part_file:
+            # Saved right away so a restart knows which file to continue
+            self._persist(job)
+
+    def get_status(self, max_queued: int = 20) -> dict:
+        """Active jobs, the first `max_queued` queued jobs and the queue's length, and recent history."""
+        return {
+            "active": [asdict(j) for j in self.active.values()],
+            "queued": [asdict(j) for j in self.queue.first(max_queued)],
+            "queued_count": len(self.queue),
+            "recent_history": [asdict(j) for j in list(self.history)[-10:]],
+            "expansions": [asdict(e) for e in self.expansions.values() if e.status == "listing" or e.error],
+            "bandwidth": dict(zip(("rate", "change_at"), self.bandwidth.current()))
+        }
+
+    def get_job(self, job_id: int) -> Optional[DownloadJob]:
+        """Look up a job by id, falling back to the store for jobs evicted from history."""
+        job = self.jobs.get(job_id)
+        if job is None and self.store:
+            job = self.store.load(job_id)
+        return job
+
+    def reprioritize(self, job_id: int, priority: Optional[int] = None,
+                     deadline: Optional[float] = None, clear_deadline: bool = False) -> Optional[DownloadJob]:
+        """
+        Change a queued job's priority and/or deadline, moving it to its new place.
+        Returns the job, or None if it isn't queued.
+        """
+        job = self.jobs.get(job_id)
+        if job is None or job not in self.queue:
+            return None
+        if clear_deadline:
+            deadline = None
+        elif deadline is None:
+            deadline = job.deadline
+        self._reprioritize(job, job.priority if priority is None else priority, deadline)
+        return job
+
+    def _reprioritize(self, job: DownloadJob, priority: int, deadline: Optional[float]):
+        if (priority, deadline) == (job.priority, job.deadline):
+            return
+        self.queue.remove(job)
+        job.priority = priority
+        job.deadline = deadline
+        self.queue.push(job)
+        self._persist(job)
 
     def cancel(self, job_id: int) -> bool:
-        with self.lock:
-            for i, job in enumerate(self.queue):
-                if job.id == job_id:
-                    job.status = DownloadStatus.FAILED
-                    job.error = "Cancelled by user"
-                    job.completed_at = datetime.now().isoformat()
-                    self.queue.remove(job)
-                    self.history.append(job)
-                    return True
+        job = self.jobs.get(job_id)
+        # A job being queued again after an attempt is QUEUED before its worker pushes it back
+        if job is None or job not in self.queue:
             return False
 
+        job.status = DownloadStatus.FAILED
+        job.error = "Cancelled by user"
+        job.completed_at = datetime.now().isoformat()
+        self.queue.remove(job)
+        self.pending.pop(self.duplicate_key(job), None)
+        self._add_history(job)
+        self._persist(job)
+        return True
+
     def clear_history(self):
-        with self.lock:
-            self.history.clear()
+        for job in self.history:
+            self.jobs.pop(job.id, None)
+        self.history.clear()
+        if self.store:
+            self.store.delete_finished()
 
 
 # Global queue instance
 download_queue = DownloadQueue()
 
 
+class MetadataCache:
+    """
+    Cache of yt-dlp --dump-json output, keyed by URL and the VPN it was extracted through.
+
+    Entries live in an in-memory LRU of `max_entries` and, if cache_dir is set, as
+    JSON files on disk that a download can hand straight to yt-dlp --load-info-json.
+    Writing a file prunes the directory to the newest `max_entries` fresh files.
+    Format URLs in the info can be tied to the requesting IP, which is why the VPN
+    interface (or None for a direct connection) is part of the key. Entries older
+    than `ttl` seconds are treated as missing, since format URLs also expire.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 32, cache_dir: Optional[Path] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        # key -> (stored_at, info)
+        self.entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+
+    def get(self, url: str, route: Optional[str]) -> Optional[dict]:
+        if self.ttl <= 0:
+            return None
+        key = self._key(url, route)
+
+        entry = self.entries.get(key)
+        if entry and time.time() - entry[0] < self.ttl:
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        path = self._fresh_file(key)
+        if path:
+            try:
+                info = json.loads(path.read_text())
+            except (OSError, ValueError):
+                return None
+            self._remember(key, path.stat().st_mtime, info)
+            return info
+        return None
+
+    def put(self, url: str, route: Optional[str], info: dict):
+        if self.ttl <= 0:
+            return
+        key = self._key(url, route)
+        self._remember(key, time.time(), info)
+        if self.cache_dir:
+            try:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                self._path(key).write_text(json.dumps(info))
+                self._prune_files()
+            except OSError:
+                pass
+
+    def info_file(self, url: str, route: Optional[str]) -> Optional[Path]:
+        """Path of a fresh cached info JSON for --load-info-json, or None."""
+        if self.ttl <= 0:
+            return None
+        return self._fresh_file(self._key(url, route))
+
+    def invalidate(self, url: str, route: Optional[str]):
+        key = self._key(url, route)
+        self.entries.pop(key, None)
+        if self.cache_dir:
+            self._path(key).unlink(missing_ok=True)
+
+    def _remember(self, key: str, stored_at: float, info: dict):
+        self.entries[key] = (stored_at, info)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _fresh_file(self, key: str) -> Optional[Path]:
+        if not self.cache_dir:
+            return None
+        path = self._path(key)
+        try:
+            if time.time() - path.stat().st_mtime < self.ttl:
+                return path
+            path.unlink()
+        except OSError:
+            pass
+        return None
+
+    def _prune_files(self):
+        """Delete expired files, then all but the newest `max_entries`."""
+        now = time.time()
+        files = []
+        for path in self.cache_dir.glob("*.info.json"):
+            try:
+                stored_at = path.stat().st_mtime
+                if now - stored_at < self.ttl:
+                    files.append((stored_at, path))
+                else:
+                    path.unlink()
+            except OSError:
+                continue
+        files.sort(reverse=True)
+        for _, path in files[self.max_entries:]:
+            path.unlink(missing_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.info.json"
+
+    @staticmethod
+    def _key(url: str, route: Optional[str]) -> str:
+        return hashlib.sha256(f"{url}\0{route or ''}".encode()).hexdigest()
+
+
+# Global metadata cache instance
+metadata_cache = MetadataCache(cache_dir=DEFAULT_METADATA_CACHE_DIR)
+
+
 def get_available_configs() -> list[Path]:
     """Get all available WireGuard configs."""
-    if not WIREGUARD_DIR.exists():
-        return []
-    return sorted(WIREGUARD_DIR.glob("*.conf"))
+    return config_inventory.refresh().configs
 
 
 def parse_config_location(config_path: Path) -> dict[str, str]:
@@ -170,32 +1071,893 @@ def parse_config_location(config_path: Path) -> dict[str, str]:
     return {}
 
 
-def get_active_wireguard() -> Optional[str]:
-    """Check if any WireGuard interface is currently active."""
+class ConfigInventory:
+    """
+    Index of the configs in WIREGUARD_DIR by country and city.
+
+    The directory is only re-globbed and re-parsed when its mtime changes (which
+    happens whenever a config is added, removed or renamed), so lookups are a stat
+    plus a dict access.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.mtime: Optional[float] = None
+        self.configs: list[Path] = []
+        self.locations: dict[Path, dict[str, str]] = {}
+        self.by_country: dict[str, list[Path]] = {}
+        self.by_city: dict[tuple[str, str], list[Path]] = {}
+
+    def refresh(self) -> "ConfigInventory":
+        try:
+            mtime = self.directory.stat().st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return self
+
+        self.mtime = mtime
+        self.configs = sorted(self.directory.glob("*.conf")) if mtime is not None else []
+        self.locations = {}
+        self.by_country = {}
+        self.by_city = {}
+        for config in self.configs:
+            location = parse_config_location(config)
+            self.locations[config] = location
+            country = location.get("country")
+            if country:
+                self.by_country.setdefault(country, []).append(config)
+                self.by_city.setdefault((country, location["city"]), []).append(config)
+        return self
+
+
+# Global config inventory instance
+config_inventory = ConfigInventory(WIREGUARD_DIR)
+
+
+@dataclass
+class EndpointStat:
+    """Rolling (exponentially weighted) measurements for one WireGuard config."""
+    up_seconds: Optional[float] = None
+    throughput: Optional[float] = None  # bytes/s
+    failure_rate: float = 0.0
+    downloads: int = 0
+    # From HealthProber: 1.0 healthy .. 0.0 dead, and when it was last probed (epoch seconds)
+    health: Optional[float] = None
+    health_checked_at: Optional[float] = None
+    probe_throughput: Optional[float] = None  # bytes/s
+
+
+class EndpointStats:
+    """
+    Per-config statistics used by select_best_config to pick an endpoint.
+
+    Configs whose recent health probes (see HealthProber) put them below
+    `min_health` are skipped while any healthy alternative exists; a health
+    reading older than `health_ttl` seconds is ignored so a skipped config gets
+    another chance. A config whose tunnel is already up or lingering is kept, so
+    consecutive jobs reuse it. Only when a tunnel has to come up anyway are the
+    others compared: configs with no completed downloads are tried first, then
+    the best scoring config is used, except that with probability `explore` a
+    random one is picked so the statistics of the others stay current.
+    """
+
+    def __init__(self, alpha: float = 0.3, explore: float = 0.1, min_health: float = 0.5,
+                 health_ttl: float = 1800):
+        self.alpha = alpha
+        self.explore = explore
+        self.min_health = min_health
+        self.health_ttl = health_ttl
+        self.stats: dict[str, EndpointStat] = {}
+        self.store: Optional[JobStore] = None
+
+    def attach_store(self, store: JobStore):
+        self.store = store
+        known = {f.name for f in fields(EndpointStat)}
+        for name, data in store.load_endpoints().items():
+            self.stats[name] = EndpointStat(**{k: v for k, v in data.items() if k in known})
+
+    def record_up(self, config: Path, seconds: float, success: bool):
+        stat = self.stats.setdefault(config.stem, EndpointStat())
+        if success:
+            stat.up_seconds = self._average(stat.up_seconds, seconds)
+        stat.failure_rate = self._average(stat.failure_rate, 0.0 if success else 1.0)
+        self._save(config.stem)
+
+    def record_download(self, config: Path, throughput: Optional[float], success: bool):
+        stat = self.stats.setdefault(config.stem, EndpointStat())
+        if success:
+            stat.downloads += 1
+            if throughput:
+                stat.throughput = self._average(stat.throughput, throughput)
+        stat.failure_rate = self._average(stat.failure_rate, 0.0 if success else 1.0)
+        self._save(config.stem)
+
+    def record_health(self, config: Path, healthy: bool, probe_throughput: Optional[float] = None):
+        stat = self.stats.setdefault(config.stem, EndpointStat())
+        stat.health = self._average(stat.health, 1.0 if healthy else 0.0)
+        stat.health_checked_at = time.time()
+        if probe_throughput:
+            stat.probe_throughput = self._average(stat.probe_throughput, probe_throughput)
+        self._save(config.stem)
+
+    def expected_throughput(self, config: Path) -> Optional[float]:
+        """Measured download (or else probe) throughput through config in bytes/s, if any."""
+        stat = self.stats.get(config.stem)
+        if stat is None:
+            return None
+        return stat.throughput or stat.probe_throughput
+
+    def is_degraded(self, config: Path) -> bool:
+        stat = self.stats.get(config.stem)
+        if stat is None or stat.health is None or stat.health_checked_at is None:
+            return False
+        if time.time() - stat.health_checked_at > self.health_ttl:
+            return False
+        return stat.health < self.min_health
+
+    def score(self, config: Path) -> float:
+        """Expected useful throughput, discounted for failures and slow tunnel bring-up."""
+        stat = self.stats.get(config.stem)
+        if stat is None or not stat.throughput:
+            return 0.0
+        return stat.throughput * (1 - stat.failure_rate) / (1 + (stat.up_seconds or 0) / 60)
+
+    def choose(self, configs: list[Path], live: Collection[Path] = ()) -> Path:
+        """Pick one of configs; `live` are the configs whose tunnels are up or lingering."""
+        healthy = [c for c in configs if not self.is_degraded(c)]
+        reusable = [c for c in healthy if c in live]
+        if reusable:
+            return reusable[0]
+        configs = healthy or configs
+        untried = [c for c in configs if c.stem not in self.stats or
+                   (not self.stats[c.stem].downloads and self.stats[c.stem].failure_rate < 0.5)]
+        if untried:
+            return untried[0]
+        if random.random() < self.explore:
+            return random.choice(configs)
+        return max(configs, key=self.score)
+
+    def _average(self, current: Optional[float], sample: float) -> float:
+        return sample if current is None else (1 - self.alpha) * current + self.alpha * sample
+
+    def _save(self, name: str):
+        if self.store:
+            self.store.save_endpoint(name, asdict(self.stats[name]))
+
+
+# Global endpoint statistics instance
+endpoint_stats = EndpointStats()
+
+
+async def run_command(cmd: list[str], timeout: Optional[float] = None, check: bool = False) -> subprocess.CompletedProcess:
+    """
+    Run a command without blocking the event loop.
+    Mirrors subprocess.run(capture_output=True, text=True): raises TimeoutExpired
+    (after killing the process) and, with check=True, CalledProcessError.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
     try:
-        result = subprocess.run(
-            ["wg", "show", "interfaces"],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        interfaces = result.stdout.strip().split()
-        return interfaces[0] if interfaces else None
-    except (subprocess.CalledProcessError, FileNotFoundError):
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, timeout)
+
+    result = subprocess.CompletedProcess(
+        cmd,
+        proc.returncode,
+        stdout.decode(errors="replace"),
+        stderr.decode(errors="replace")
+    )
+    if check:
+        result.check_returncode()
+    return result
+
+
+async def stream_command(cmd: list[str], on_line: Callable[[str], None],
+                         timeout: Optional[float] = None,
+                         should_stop: Optional[Callable[[], object]] = None) -> tuple[int, str]:
+    """
+    Run a command, passing each line of combined stdout/stderr to on_line as it arrives.
+    Only the last OUTPUT_TAIL_LINES lines are kept; returns (returncode, tail).
+    Raises TimeoutExpired (after stopping the process) if it runs longer than timeout,
+    or once should_stop (polled every second) returns something true.
+    """
+    started = time.monotonic()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT
+    )
+    tail: deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    async def read_output():
+        async for raw in proc.stdout:
+            line = raw.decode(errors="replace").rstrip()
+            on_line(line)
+            tail.append(line)
+        await proc.wait()
+
+    async def poll_should_stop():
+        while not should_stop():
+            await asyncio.sleep(1)
+
+    reader = asyncio.ensure_future(read_output())
+    waiters = [reader]
+    if should_stop:
+        waiters.append(asyncio.ensure_future(poll_should_stop()))
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finished = reader.done()
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+    if finished:
+        reader.result()
+    else:
+        # SIGTERM first: sudo (see NamespaceTunnels.exec_prefix) only relays catchable
+        # signals, and it gives yt-dlp a chance to leave its .part file consistent
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), 5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        raise subprocess.TimeoutExpired(cmd, time.monotonic() - started)
+
+    return proc.returncode, "\n".join(tail)
+
+
+async def iter_lines(cmd: list[str], idle_timeout: float) -> AsyncIterator[str]:
+    """
+    Run a command and yield its non-empty stdout lines (up to JSON_LINE_LIMIT long) as they
+    arrive. Raises TimeoutExpired (after killing the process) if it goes `idle_timeout`
+    seconds without printing a line, and CalledProcessError if it fails.
+
+    >>> async def lengths(cmd):
+    ...     return [len(line) async for line in iter_lines(cmd, 10)]
+    >>> asyncio.run(lengths([sys.executable, "-c", "print('x' * 200000); print(); print('y')"]))
+    [200000, 1]
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=JSON_LINE_LIMIT
+    )
+    stderr = asyncio.ensure_future(proc.stderr.read())
+    try:
+        while True:
+            try:
+                raw = await asyncio.wait_for(proc.stdout.readline(), idle_timeout)
+            except asyncio.TimeoutError:
+                raise subprocess.TimeoutExpired(cmd, idle_timeout)
+            if not raw:
+                break
+            line = raw.decode(errors="replace").strip()
+            if line:
+                yield line
+        if await proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                                stderr=(await stderr).decode(errors="replace"))
+    finally:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        stderr.cancel()
+
+
+def parse_progress_line(line: str) -> Optional[dict]:
+    """Parse a PROGRESS_TEMPLATE line into DownloadJob progress fields, or None for other output."""
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+
+    values = line[len(PROGRESS_PREFIX):].split(maxsplit=len(PROGRESS_FIELDS))
+    if len(values) != len(PROGRESS_FIELDS) + 1:
         return None
+    return normalize_progress({**dict(zip(PROGRESS_FIELDS, values)), "tmpfilename": values[-1]})
+
+
+def normalize_progress(values: dict) -> dict:
+    """Convert raw yt-dlp progress values (numbers, numeric strings or NA) into DownloadJob progress fields."""
+    progress = {}
+    for field in PROGRESS_FIELDS:
+        try:
+            number = float(values.get(field))
+            progress[field] = number if field == "speed" else int(number)
+        except (TypeError, ValueError):
+            progress[field] = None
+
+    # Fragmented downloads only have an estimate of the total size
+    estimate = progress.pop("total_bytes_estimate")
+    if progress["total_bytes"] is None and estimate is not None:
+        progress["total_bytes"] = estimate
+
+    tmpfilename = values.get("tmpfilename")
+    progress["part_file"] = tmpfilename if tmpfilename and tmpfilename != "NA" else None
+    return progress
+
+
+def partial_size(job: DownloadJob) -> int:
+    """Bytes an interrupted job has on disk: its .part file, or the last reported progress."""
+    try:
+        return Path(job.part_file).stat().st_size
+    except (TypeError, OSError):
+        # Fragmented downloads keep their progress in separate fragment files
+        return job.downloaded_bytes or 0
+
+
+def format_bytes(size: float) -> str:
+    """Human-readable byte count (e.g., 1.5MiB)."""
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+def expected_filesize(info: Optional[dict]) -> Optional[int]:
+    """Size of the formats yt-dlp selected in a --dump-json info dict, exact or approximate."""
+    if not info:
+        return None
+    formats = info.get("requested_formats") or [info]
+    sizes = [f.get("filesize") or f.get("filesize_approx") for f in formats]
+    return int(sum(sizes)) if all(sizes) else None
+
+
+class DownloadWatchdog:
+    """
+    Decides when a running download should be stopped. Fed the download's progress
+    reports (see parse_progress_line) and polled about once a second.
+
+    A download is stalled when its byte count hasn't moved for `stall_timeout`
+    seconds; until the first progress report that covers extraction too. Once a
+    file is complete (merging or post-processing) the stall check waits for the
+    next one. Separately, as soon as both an expected size (`expected_bytes`, else
+    yt-dlp's reported total) and a throughput (`expected_speed`, else the average
+    over the first `warmup` seconds) are known, the download gets a deadline of
+    `slack` times the time the remaining bytes should take, but no less than
+    `min_deadline` seconds. Without those there is no deadline; the stall check
+    alone bounds the download. A download is also stopped at `window_end` (monotonic
+    time), when the queue's bandwidth schedule changes its rate.
+
+    Plain data so the in-process engine can run a copy in its worker.
+    """
+
+    WINDOW_CHANGED = "the download rate changed"
+
+    def __init__(self, stall_timeout: float, slack: float, min_deadline: float,
+                 expected_bytes: Optional[int] = None, expected_speed: Optional[float] = None,
+                 warmup: float = 30.0, window_end: Optional[float] = None):
+        self.stall_timeout = stall_timeout
+        self.slack = slack
+        self.min_deadline = min_deadline
+        self.expected_bytes = expected_bytes
+        self.expected_speed = expected_speed
+        self.warmup = warmup
+        self.window_end = window_end
+        self.started = time.monotonic()
+        self.last_advance = self.started
+        self.last_bytes: Optional[int] = None
+        # Bytes already on disk when the first report came in (resumed downloads)
+        self.first_bytes: Optional[int] = None
+        self.first_report: Optional[float] = None
+        self.file_complete = False
+        self.deadline: Optional[float] = None
+        self.reason: Optional[str] = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def restart(self):
+        """Start the clocks now, for a download that waited before it began."""
+        self.started = time.monotonic()
+        self.last_advance = self.started
+
+    def update(self, progress: dict):
+        now = time.monotonic()
+        downloaded = progress.get("downloaded_bytes")
+        total = progress.get("total_bytes")
+        if downloaded is None:
+            return
+
+        if downloaded != self.last_bytes:
+            self.last_advance = now
+            self.last_bytes = downloaded
+        self.file_complete = total is not None and downloaded >= total
+        if self.first_report is None:
+            self.first_bytes = downloaded
+            self.first_report = now
+        if self.expected_bytes is None and total:
+            self.expected_bytes = total
+
+        if self.deadline is None and self.expected_bytes:
+            speed = self.expected_speed
+            if not speed and now - self.first_report >= self.warmup:
+                speed = (downloaded - self.first_bytes) / (now - self.first_report)
+            if speed and speed > 0:
+                remaining = max(0, self.expected_bytes - self.first_bytes)
+                self.deadline = self.started + max(self.min_deadline, self.slack * remaining / speed)
+
+    def expired(self) -> Optional[str]:
+        """Why the download should be stopped, or None while it may continue."""
+        now = time.monotonic()
+        if self.window_end is not None and now >= self.window_end:
+            self.reason = self.WINDOW_CHANGED
+        elif not self.file_complete and now - self.last_advance > self.stall_timeout:
+            self.reason = f"no progress for {self.stall_timeout:.0f}s"
+        elif self.deadline is not None and now > self.deadline:
+            self.reason = f"still running after its {self.deadline - self.started:.0f}s deadline"
+        return self.reason
+
+
+class WatchdogPolicy:
+    """Settings for the DownloadWatchdog given to each download attempt (see --stall-timeout)."""
+
+    def __init__(self, stall_timeout: float = 120.0, slack: float = 3.0, min_deadline: float = 600.0):
+        self.stall_timeout = stall_timeout
+        self.slack = slack
+        self.min_deadline = min_deadline
+
+    def watch(self, expected_bytes: Optional[int] = None, expected_speed: Optional[float] = None,
+              window_end: Optional[float] = None) -> DownloadWatchdog:
+        return DownloadWatchdog(self.stall_timeout, self.slack, self.min_deadline,
+                                expected_bytes=expected_bytes, expected_speed=expected_speed,
+                                window_end=window_end)
+
+
+# Global watchdog settings
+watchdog_policy = WatchdogPolicy()
+
+
+def playlist_entry_url(entry: dict) -> Optional[str]:
+    """
+    URL to download a --flat-playlist entry from. Flat entries only carry `url`; a single
+    video's full info has `webpage_url`, where `url` would be the media stream itself.
+    """
+    return entry.get("webpage_url") or entry.get("url")
+
+
+class YtDlpError(Exception):
+    """yt-dlp failed; the message is its error output."""
+
+
+# yt-dlp error output -> kind. geo and network errors may go away through another
+# endpoint; permanent ones won't. Checked in order: geo-blocks first, since YouTube words
+# them as "Video unavailable. The uploader has not made this video available in your
+# country"; then permanent errors, since a 404 page is also "Unable to download webpage".
+DOWNLOAD_ERROR_PATTERNS = [
+    ("geo", re.compile(
+        r"geo.?restrict|not (?:be )?available (?:in|from) your (?:country|location)|"
+        r"blocked (?:it )?in your country|geo.?block|made this video available in your country",
+        re.IGNORECASE)),
+    ("permanent", re.compile(
+        r"HTTP Error (?:404|410)|Video unavailable|Private video|has been removed|"
+        r"does not exist|Unsupported URL|Requested format is not available|not a valid URL",
+        re.IGNORECASE)),
+    ("network", re.compile(
+        r"Unable to download|Connection (?:reset|refused|aborted)|timed? ?out|"
+        r"Temporary failure in name resolution|Name or service not known|Network is unreachable|"
+        r"Remote end closed connection|IncompleteRead|SSL|HTTP Error (?:429|5\d\d)",
+        re.IGNORECASE)),
+]
+
+
+def classify_download_error(output: str) -> str:
+    """
+    Kind of a failed download from yt-dlp's output: geo, network, permanent or unknown.
+
+    >>> classify_download_error("ERROR: [youtube] x: Video unavailable. "
+    ...                         "The uploader has not made this video available in your country")
+    'geo'
+    >>> classify_download_error("ERROR: [BBC] x: This programme is not available from your location")
+    'geo'
+    >>> classify_download_error("ERROR: [youtube] x: Video unavailable. This video has been removed by the uploader")
+    'permanent'
+    >>> classify_download_error("ERROR: [generic] Unable to download webpage: HTTP Error 404: Not Found")
+    'permanent'
+    >>> classify_download_error("ERROR: Unable to download webpage: <urlopen error [Errno 111] Connection refused>")
+    'network'
+    >>> classify_download_error("ERROR: unable to download video data: HTTP Error 503: Service Unavailable")
+    'network'
+    >>> classify_download_error("ERROR: Postprocessing: ffmpeg not found")
+    'unknown'
+    """
+    errors = [line for line in output.splitlines() if line.startswith("ERROR:")] or [output]
+    for kind, pattern in DOWNLOAD_ERROR_PATTERNS:
+        if any(pattern.search(line) for line in errors):
+            return kind
+    return "unknown"
+
+
+class DownloadFailed(Exception):
+    """
+    A download attempt failed. The message is a one-line summary; `kind` is as in
+    classify_download_error, or "schedule" for a download stopped because the
+    bandwidth schedule changed its rate. `config` is the WireGuard config the attempt
+    went through (if any) and `details` the full report.
+    """
+
+    def __init__(self, summary: str, kind: str, config: Optional[Path], details: str):
+        super().__init__(summary)
+        self.kind = kind
+        self.config = config
+        self.details = details
+
+
+class DownloadInterrupted(DownloadFailed):
+    """A download stopped part-way, leaving a partial file the next attempt can continue."""
+
+
+@lru_cache(maxsize=1)
+def yt_dlp_command() -> tuple[str, ...]:
+    """
+    The yt-dlp CLI as found on this server's PATH, by absolute path so the netns helper
+    (which runs it under sudo's secure_path) starts the same one. Without a yt-dlp
+    executable, the yt_dlp module is run with this interpreter.
+    """
+    path = shutil.which("yt-dlp")
+    return (str(Path(path).absolute()),) if path else (sys.executable, "-m", "yt_dlp")
+
+
+class SubprocessEngine:
+    """Runs the yt-dlp CLI for each call."""
+
+    name = "subprocess"
+
+    async def download(self, source: list[str], output_template: str, format_spec: str,
+                       on_progress: Optional[Callable[[dict], None]], watchdog: DownloadWatchdog,
+                       prefix: Sequence[str] = (), resume: bool = False,
+                       archive: Optional[Path] = None, rate_limit: Optional[float] = None) -> tuple[int, str]:
+        """
+        Download `source` (a URL, or ["--load-info-json", path]). Returns (returncode, output tail)
+        and raises TimeoutExpired once `watchdog` says to stop. `prefix` wraps the yt-dlp command
+        (see NamespaceTunnels.exec_prefix). With `resume`, an existing partial file is continued.
+        With an `archive` file, a video listed in it is skipped and a finished one is added.
+        `rate_limit` caps the download speed in bytes/s.
+        """
+        cmd = [
+            *prefix,
+            *yt_dlp_command(),
+            "--newline",
+            "--progress-template", PROGRESS_TEMPLATE,
+            *(["--continue"] if resume else []),
+            *(["--download-archive", str(archive)] if archive else []),
+            *(["--limit-rate", str(int(rate_limit))] if rate_limit else []),
+            "-f", format_spec,
+            "-o", output_template,
+            *source
+        ]
+
+        def on_line(line: str):
+            progress = parse_progress_line(line)
+            if progress:
+                watchdog.update(progress)
+                if on_progress:
+                    on_progress(progress)
+
+        returncode, output = await stream_command(cmd, on_line, should_stop=watchdog.expired)
+        # Progress lines are only useful while the download runs
+        output = "\n".join(line for line in output.splitlines() if not line.startswith(PROGRESS_PREFIX))
+        return returncode, output
+
+    async def extract_info(self, url: str, timeout: float) -> dict:
+        try:
+            result = await run_command([*yt_dlp_command(), "--dump-json", url], timeout=timeout, check=True)
+        except subprocess.CalledProcessError as e:
+            raise YtDlpError(e.stderr)
+        return json.loads(result.stdout)
+
+    async def iter_playlist(self, url: str, idle_timeout: float) -> AsyncIterator[str]:
+        """
+        Yield the URLs of a playlist's entries (or just the video's, for a single video) as
+        yt-dlp lists them, without extracting each. Raises TimeoutExpired if yt-dlp goes
+        `idle_timeout` seconds without listing another entry.
+        """
+        cmd = [*yt_dlp_command(), "--flat-playlist", "--lazy-playlist", "--dump-json", url]
+        try:
+            async for line in iter_lines(cmd, idle_timeout):
+                entry_url = playlist_entry_url(json.loads(line))
+                if entry_url:
+                    yield entry_url
+        except subprocess.CalledProcessError as e:
+            raise YtDlpError(e.stderr)
+
+
+# Set in in-process engine worker processes by _engine_worker_init
+_engine_progress_queue = None
+
+
+def _engine_worker_init(progress_queue):
+    global _engine_progress_queue
+    _engine_progress_queue = progress_queue
+    # Pay the extractor import cost once per worker rather than per job
+    import yt_dlp  # noqa: F401
+
+
+class _EngineLogger:
+    """yt-dlp logger that keeps the last OUTPUT_TAIL_LINES messages."""
+
+    def __init__(self):
+        self.lines: deque[str] = deque(maxlen=OUTPUT_TAIL_LINES)
+
+    def debug(self, msg):
+        # yt-dlp routes normal screen output here too; only drop --verbose output
+        if not msg.startswith("[debug] "):
+            self.lines.append(msg)
+
+    def info(self, msg):
+        self.lines.append(msg)
+
+    def warning(self, msg):
+        self.lines.append(f"WARNING: {msg}")
+
+    def error(self, msg):
+        self.lines.append(msg)
+
+    def exception(self, e: Exception):
+        """Record an exception unless yt-dlp already logged it as an error."""
+        if not self.lines or self.lines[-1] != str(e):
+            self.lines.append(str(e))
+
+
+class _EngineTimeout(Exception):
+    pass
+
+
+def _engine_download(token: int, source: list[str], output_template: str, format_spec: str,
+                     watchdog: DownloadWatchdog, resume: bool, archive: Optional[Path],
+                     rate_limit: Optional[float]) -> tuple[int, str, Optional[str]]:
+    """
+    Runs in an engine worker process. Returns (returncode, output tail, why the watchdog
+    stopped it or None).
+    """
+    import yt_dlp
+
+    logger = _EngineLogger()
+    stopped = None
+
+    def hook(status: dict):
+        progress = normalize_progress(status)
+        watchdog.update(progress)
+        _engine_progress_queue.put((token, progress))
+
+    def check_watchdog(signum, frame):
+        # SIGALRM also interrupts a blocked socket read, so stalls are caught too
+        nonlocal stopped
+        stopped = watchdog.expired()
+        if stopped:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            raise _EngineTimeout(stopped)
+
+    options = {
+        "format": format_spec,
+        "outtmpl": output_template,
+        "logger": logger,
+        "progress_hooks": [hook],
+        "noprogress": True,
+    }
+    if resume:
+        options["continuedl"] = True
+    if archive:
+        options["download_archive"] = str(archive)
+    if rate_limit:
+        options["ratelimit"] = rate_limit
+    # The call may have queued behind other calls for a pool process; that wait isn't a stall
+    watchdog.restart()
+    signal.signal(signal.SIGALRM, check_watchdog)
+    signal.setitimer(signal.ITIMER_REAL, 1.0, 1.0)
+    try:
+        with yt_dlp.YoutubeDL(options) as ydl:
+            if source[0] == "--load-info-json":
+                returncode = ydl.download_with_info_file(source[1])
+            else:
+                returncode = ydl.download(source)
+    except Exception as e:
+        if not stopped:
+            logger.exception(e)
+        returncode = 1
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    return returncode, "\n".join(logger.lines), stopped
+
+
+def _engine_extract_info(url: str) -> tuple[Optional[dict], str]:
+    """Runs in an engine worker process. Returns (info, error output)."""
+    import yt_dlp
+
+    logger = _EngineLogger()
+    try:
+        with yt_dlp.YoutubeDL({"logger": logger}) as ydl:
+            return ydl.sanitize_info(ydl.extract_info(url, download=False)), ""
+    except Exception as e:
+        logger.exception(e)
+        return None, "\n".join(logger.lines)
+
+
+class InProcessEngine:
+    """
+    Drives yt_dlp.YoutubeDL in a pool of long-lived worker processes, so interpreter
+    startup and extractor imports are paid once per worker instead of once per call,
+    while a crashing download can't take the server down. Progress hooks are sent
+    back over a multiprocessing queue and dispatched on the event loop.
+    """
+
+    name = "inprocess"
+
+    def __init__(self, processes: int = 2):
+        self.processes = processes
+        self.pool: Optional[ProcessPoolExecutor] = None
+        self.progress_queue = None
+        self.listeners: dict[int, Callable[[dict], None]] = {}
+        self.next_token = 1
+
+    def _ensure_pool(self) -> ProcessPoolExecutor:
+        if self.pool is None:
+            # spawn rather than fork: the server process has a running event loop and threads
+            context = multiprocessing.get_context("spawn")
+            if self.progress_queue is None:
+                self.progress_queue = context.Queue()
+                loop = asyncio.get_running_loop()
+                threading.Thread(target=self._pump_progress, args=(loop,), daemon=True).start()
+            self.pool = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=context,
+                initializer=_engine_worker_init,
+                initargs=(self.progress_queue,)
+            )
+        return self.pool
+
+    def _pump_progress(self, loop: asyncio.AbstractEventLoop):
+        while True:
+            token, progress = self.progress_queue.get()
+            loop.call_soon_threadsafe(self._dispatch, token, progress)
+
+    def _dispatch(self, token: int, progress: dict):
+        listener = self.listeners.get(token)
+        if listener:
+            listener(progress)
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._ensure_pool(), func, *args)
+        except BrokenProcessPool:
+            # A worker died mid-call; start a fresh pool for the next one
+            self.pool = None
+            raise YtDlpError("yt-dlp worker process crashed")
+
+    async def download(self, source: list[str], output_template: str, format_spec: str,
+                       on_progress: Optional[Callable[[dict], None]], watchdog: DownloadWatchdog,
+                       prefix: Sequence[str] = (), resume: bool = False,
+                       archive: Optional[Path] = None, rate_limit: Optional[float] = None) -> tuple[int, str]:
+        if prefix:
+            # Pool workers live in the host namespace; a wrapped download needs its own process
+            return await SubprocessEngine().download(source, output_template, format_spec,
+                                                     on_progress, watchdog, prefix, resume, archive, rate_limit)
+        token = self.next_token
+        self.next_token += 1
+        if on_progress:
+            self.listeners[token] = on_progress
+        try:
+            returncode, output, stopped = await self._run(
+                _engine_download, token, source, output_template, format_spec, watchdog, resume, archive,
+                rate_limit
+            )
+        finally:
+            self.listeners.pop(token, None)
+        if stopped:
+            # The worker ran its own copy of the watchdog
+            watchdog.reason = stopped
+            raise subprocess.TimeoutExpired(["yt-dlp", *source], watchdog.elapsed())
+        return returncode, output
+
+    async def extract_info(self, url: str, timeout: float) -> dict:
+        try:
+            info, error = await asyncio.wait_for(self._run(_engine_extract_info, url), timeout)
+        except asyncio.TimeoutError:
+            raise subprocess.TimeoutExpired(["yt-dlp", url], timeout)
+        if info is None:
+            raise YtDlpError(error)
+        return info
 
+    async def iter_playlist(self, url: str, idle_timeout: float) -> AsyncIterator[str]:
+        # A channel can take minutes to list; doing that in a pool process would hold up
+        # downloads waiting for one, so listings get a yt-dlp process of their own
+        async for entry_url in SubprocessEngine().iter_playlist(url, idle_timeout):
+            yield entry_url
 
-def wireguard_up(config_path: Path) -> tuple[bool, str]:
+
+# Global yt-dlp engine instance (see --engine)
+engine = SubprocessEngine()
+
+
+class InterfaceTracker:
+    """
+    Tracks which WireGuard interfaces are up without spawning `wg` for every check.
+
+    Interfaces are read from sysfs (a WireGuard device's uevent has DEVTYPE=wireguard),
+    falling back to `wg show interfaces` where sysfs isn't available or only shows tun
+    devices, which is how userspace WireGuard (wireguard-go) looks there. Interfaces this
+    server brought up itself count as long as their sysfs entry exists. The result is
+    cached for `ttl` seconds and updated directly when this server brings an interface
+    up or down, so refreshing is only needed to notice changes made outside the server.
+    """
+
+    def __init__(self, sysfs: Path = Path("/sys/class/net"), ttl: float = 5.0):
+        self.sysfs = sysfs
+        self.ttl = ttl
+        self.interfaces: set[str] = set()
+        self.brought_up: set[str] = set()
+        self.refreshed_at: Optional[float] = None
+
+    async def active(self) -> Optional[str]:
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.ttl:
+            await self.refresh()
+        return min(self.interfaces) if self.interfaces else None
+
+    async def refresh(self):
+        if self.sysfs.is_dir():
+            interfaces, tun_present = self._read_sysfs()
+            interfaces |= {name for name in self.brought_up if (self.sysfs / name).exists()}
+            if not interfaces and tun_present:
+                interfaces = await self._wg_interfaces()
+            self.interfaces = interfaces
+        else:
+            self.interfaces = await self._wg_interfaces()
+        self.refreshed_at = time.monotonic()
+
+    def mark_up(self, interface: str):
+        self.interfaces.add(interface)
+        self.brought_up.add(interface)
+
+    def mark_down(self, interface: str):
+        self.interfaces.discard(interface)
+        self.brought_up.discard(interface)
+
+    def _read_sysfs(self) -> tuple[set[str], bool]:
+        """Kernel WireGuard interfaces, and whether any tun device is present."""
+        interfaces = set()
+        tun_present = False
+        for device in self.sysfs.iterdir():
+            try:
+                if "DEVTYPE=wireguard" in (device / "uevent").read_text():
+                    interfaces.add(device.name)
+                elif (device / "tun_flags").exists():
+                    tun_present = True
+            except OSError:
+                continue
+        return interfaces, tun_present
+
+    async def _wg_interfaces(self) -> set[str]:
+        try:
+            result = await run_command(["wg", "show", "interfaces"], check=True)
+            return set(result.stdout.split())
+        except (subprocess.CalledProcessError, FileNotFoundError):
+            return set()
+
+
+# Global interface tracker instance
+interface_tracker = InterfaceTracker()
+
+
+async def get_active_wireguard() -> Optional[str]:
+    """Check if any WireGuard interface is currently active."""
+    return await interface_tracker.active()
+
+
+async def wireguard_up(config_path: Path) -> tuple[bool, str]:
     """Bring up a WireGuard interface."""
     interface = config_path.stem
     try:
-        subprocess.run(
-            ["sudo", "wg-quick", "up", interface],
-            capture_output=True,
-            text=True,
-            check=True,
-            timeout=30
-        )
+        await run_command(["sudo", "wg-quick", "up", interface], timeout=30, check=True)
+        interface_tracker.mark_up(interface)
         return True, f"WireGuard interface {interface} is now up"
     except subprocess.CalledProcessError as e:
         return False, f"Failed to start {interface}: {e.stderr}"
@@ -203,16 +1965,11 @@ def wireguard_up(config_path: Path) -> tuple[bool, str]:
         return False, f"Timeout starting {interface}"
 
 
-def wireguard_down(interface: str) -> tuple[bool, str]:
+async def wireguard_down(interface: str) -> tuple[bool, str]:
     """Bring down a WireGuard interface."""
     try:
-        subprocess.run(
-            ["sudo", "wg-quick", "down", interface],
-            capture_output=True,
-            text=True,
-            check=True,
-            timeout=30
-        )
+        await run_command(["sudo", "wg-quick", "down", interface], timeout=30, check=True)
+        interface_tracker.mark_down(interface)
         return True, f"WireGuard interface {interface} is now down"
     except subprocess.CalledProcessError as e:
         return False, f"Failed to stop {interface}: {e.stderr}"
@@ -220,157 +1977,652 @@ def wireguard_down(interface: str) -> tuple[bool, str]:
         return False, f"Timeout stopping {interface}"
 
 
+async def wireguard_peer_stats(interface: str) -> Optional[dict]:
+    """
+    Read the first peer of `wg show <interface> dump`: latest handshake (epoch seconds,
+    0 if none yet) and transfer counters. Returns None if wg can't be queried.
+    """
+    try:
+        result = await run_command(["sudo", "wg", "show", interface, "dump"], timeout=10, check=True)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, FileNotFoundError):
+        return None
+
+    # First line is the interface itself; peers follow as
+    # public-key preshared-key endpoint allowed-ips latest-handshake rx tx keepalive
+    for line in result.stdout.splitlines()[1:]:
+        parts = line.split("\t")
+        if len(parts) >= 7:
+            return {
+                "latest_handshake": int(parts[4]),
+                "rx_bytes": int(parts[5]),
+                "tx_bytes": int(parts[6]),
+            }
+    return None
+
+
+class TunnelManager:
+    """
+    Owns the WireGuard interface brought up by this server.
+
+    Downloads take a lease on a config and release it when done. When the last
+    lease goes the interface lingers for `linger` seconds so the next job for the
+    same config reuses it instead of re-running wg-quick. An interface started
+    with start_wireguard is pinned and stays up until stop_wireguard.
+    """
+
+    def __init__(self, linger: float = 30.0):
+        self.linger = linger
+        self.config: Optional[Path] = None
+        # When the current interface came up (epoch seconds)
+        self.up_at: Optional[float] = None
+        self.leases = 0
+        self.pinned = False
+        self.lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+
+    @property
+    def interface(self) -> Optional[str]:
+        return self.config.stem if self.config else None
+
+    @property
+    def country(self) -> Optional[str]:
+        return parse_config_location(self.config).get("country") if self.config else None
+
+    async def acquire(self, config: Path, exclude: Collection[str] = ()) -> tuple[bool, str]:
+        """
+        Take a lease on config, bringing it up (or switching to it) if needed. A tunnel
+        for the same country that other downloads hold is shared instead, unless its
+        config is in `exclude`.
+        """
+        async with self.lock:
+            if (self.leases and self.country == parse_config_location(config).get("country")
+                    and self.interface not in exclude):
+                # Another download already holds a tunnel for this country; share it
+                config = self.config
+            success, message = await self._switch_to(config)
+            if success:
+                self.leases += 1
+            return success, message
+
+    async def release(self):
+        """Drop a lease; the interface goes down after the linger timeout."""
+        async with self.lock:
+            self.leases = max(0, self.leases - 1)
+            self._schedule_down()
+
+    async def pin(self, config: Path) -> tuple[bool, str]:
+        """Bring up config and keep it up until unpin (used by start_wireguard)."""
+        async with self.lock:
+            success, message = await self._switch_to(config)
+            if success:
+                self.pinned = True
+            return success, message
+
+    async def unpin(self) -> tuple[bool, str]:
+        """Release a pinned interface, taking it down now unless downloads still use it."""
+        async with self.lock:
+            self.pinned = False
+            if self.leases:
+                return True, f"WireGuard interface {self.interface} will stop when {self.leases} active download(s) finish"
+            return await self._down()
+
+    async def drop_idle(self):
+        """Take down a lingering interface so a direct download isn't routed through it."""
+        async with self.lock:
+            if self.config and not self.leases and not self.pinned:
+                await self._down()
+
+    async def _switch_to(self, config: Path) -> tuple[bool, str]:
+        self._cancel_timer()
+        if self.config and await get_active_wireguard() != self.interface:
+            # Taken down behind our back
+            self.config = None
+            self.leases = 0
+            self.pinned = False
+
+        if self.config == config:
+            return True, f"WireGuard interface {self.interface} is already up"
+        if self.config and (self.leases or self.pinned):
+            return False, f"WireGuard interface {self.interface} is in use"
+        if self.config:
+            await self._down()
+
+        started = time.monotonic()
+        success, message = await wireguard_up(config)
+        endpoint_stats.record_up(config, time.monotonic() - started, success)
+        if success:
+            self.config = config
+            self.up_at = time.time()
+        return success, message
+
+    async def _down(self) -> tuple[bool, str]:
+        self._cancel_timer()
+        interface = self.interface
+        self.config = None
+        return await wireguard_down(interface)
+
+    def _schedule_down(self):
+        if self.config and not self.leases and not self.pinned:
+            self._cancel_timer()
+            self._timer = asyncio.create_task(self._expire())
+
+    async def _expire(self):
+        await asyncio.sleep(self.linger)
+        async with self.lock:
+            self._timer = None
+            if self.config and not self.leases and not self.pinned:
+                await self._down()
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+
+# Global tunnel manager instance
+tunnels = TunnelManager()
+
+
+# Root helper that sets up a namespace per tunnel (run via sudo, see README)
+NETNS_HELPER = Path(__file__).resolve().parent / "netns-tunnel.sh"
+
+
+class NamespaceTunnel:
+    """A WireGuard config running in its own network namespace."""
+
+    def __init__(self, config: Path, slot: int):
+        self.config = config
+        # Picks the veth subnet, 10.200.<slot>.0/30
+        self.slot = slot
+        self.up_at = time.time()
+        self.leases = 0
+        self.timer: Optional[asyncio.Task] = None
+
+    @property
+    def name(self) -> str:
+        return self.config.stem
+
+    @property
+    def namespace(self) -> str:
+        return f"yt-{self.name}"
+
+    @property
+    def country(self) -> Optional[str]:
+        return parse_config_location(self.config).get("country")
+
+
+class NamespaceTunnels:
+    """
+    Runs each WireGuard config in its own network namespace (--tunnel-mode netns),
+    so downloads for different countries proceed side by side and the host's
+    routing never changes. yt-dlp is started inside the namespace through
+    exec_prefix.
+
+    Leases and lingering work as in TunnelManager, per namespace. Without
+    `wireguard` the namespaces only get their veth link to the host, which
+    exercises the isolation locally without a VPN (--tunnel-mode netns-veth).
+    """
+
+    def __init__(self, linger: float = 30.0, wireguard: bool = True):
+        self.linger = linger
+        self.wireguard = wireguard
+        self.tunnels: dict[str, NamespaceTunnel] = {}
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, config: Path, exclude: Collection[str] = ()) -> tuple[Optional[NamespaceTunnel], str]:
+        """
+        Take a lease on config's namespace, creating it if needed. A namespace already
+        serving the same country is shared instead, unless its config is in `exclude`.
+        """
+        async with self.lock:
+            country = parse_config_location(config).get("country")
+            tunnel = self.tunnels.get(config.stem) or next(
+                # Share a namespace already serving this country rather than start another
+                (t for t in self.tunnels.values()
+                 if t.leases and t.country == country and t.name not in exclude), None
+            )
+            if tunnel is None:
+                used = {t.slot for t in self.tunnels.values()}
+                slot = next((s for s in range(256) if s not in used), None)
+                if slot is None:
+                    return None, "No free network namespace slots"
+                started = time.monotonic()
+                success, message = await self._up(config, slot)
+                if self.wireguard:
+                    endpoint_stats.record_up(config, time.monotonic() - started, success)
+                if not success:
+                    return None, message
+                tunnel = NamespaceTunnel(config, slot)
+                self.tunnels[tunnel.name] = tunnel
+
+            if tunnel.timer:
+                tunnel.timer.cancel()
+                tunnel.timer = None
+            tunnel.leases += 1
+            return tunnel, f"Namespace {tunnel.namespace} is up"
+
+    async def release(self, tunnel: NamespaceTunnel):
+        """Drop a lease; the namespace is removed after the linger timeout."""
+        async with self.lock:
+            tunnel.leases = max(0, tunnel.leases - 1)
+            if not tunnel.leases and self.tunnels.get(tunnel.name) is tunnel:
+                tunnel.timer = asyncio.create_task(self._expire(tunnel))
+
+    def exec_prefix(self, tunnel: NamespaceTunnel) -> list[str]:
+        """Command prefix that runs the rest of the command inside tunnel's namespace."""
+        return ["sudo", str(NETNS_HELPER), "exec", tunnel.name]
+
+    async def _up(self, config: Path, slot: int) -> tuple[bool, str]:
+        cmd = ["sudo", str(NETNS_HELPER), "up", config.stem, str(slot)]
+        if self.wireguard:
+            cmd.append(config.stem)
+        try:
+            await run_command(cmd, timeout=60, check=True)
+            return True, f"Namespace yt-{config.stem} is now up"
+        except subprocess.CalledProcessError as e:
+            return False, f"Failed to start namespace for {config.stem}: {e.stderr}"
+        except subprocess.TimeoutExpired:
+            return False, f"Timeout starting namespace for {config.stem}"
+
+    async def _down(self, tunnel: NamespaceTunnel):
+        self.tunnels.pop(tunnel.name, None)
+        try:
+            await run_command(["sudo", str(NETNS_HELPER), "down", tunnel.name, str(tunnel.slot)],
+                              timeout=30, check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Failed to remove namespace {tunnel.namespace}: {e.stderr}", file=sys.stderr)
+        except subprocess.TimeoutExpired:
+            print(f"Timeout removing namespace {tunnel.namespace}", file=sys.stderr)
+
+    async def _expire(self, tunnel: NamespaceTunnel):
+        await asyncio.sleep(self.linger)
+        async with self.lock:
+            tunnel.timer = None
+            if not tunnel.leases and self.tunnels.get(tunnel.name) is tunnel:
+                await self._down(tunnel)
+
+
+# Set by --tunnel-mode netns / netns-veth; None runs tunnels in the host namespace
+namespace_tunnels: Optional[NamespaceTunnels] = None
+
+
+class HealthProber:
+    """
+    Periodically checks the tunnel managed by `tunnels` and feeds the result to
+    endpoint_stats, so select_best_config can skip degraded configs.
+
+    WireGuard only handshakes while packets flow, so the age of the peer's last
+    handshake is only judged when traffic has gone through the tunnel: the probe's
+    own fetch, or rx/tx counters that moved since the last check. An idle tunnel
+    gets no reading at all. A tunnel is unhealthy if its peer hasn't completed a
+    handshake within `max_handshake_age` seconds of that traffic (WireGuard
+    re-handshakes every two minutes while in use). If `probe_url` is set, a small
+    GET is made through the tunnel first; its throughput is measured from the
+    peer's rx counter, and a failed or slower than `min_throughput` fetch also
+    counts as unhealthy.
+    """
+
+    def __init__(self, interval: float = 60.0, probe_url: Optional[str] = None,
+                 max_handshake_age: float = 180.0, min_throughput: float = 10 * 1024):
+        self.interval = interval
+        self.probe_url = probe_url
+        self.max_handshake_age = max_handshake_age
+        self.min_throughput = min_throughput
+        # (rx, tx) counters of each config at its last check
+        self.counters: dict[str, tuple[int, int]] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start probing (called once the event loop is running)."""
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if tunnels.config:
+                await self.probe(tunnels.config)
+
+    async def probe(self, config: Path) -> Optional[bool]:
+        """Check config's tunnel. Returns whether it is healthy, or None without a reading."""
+        stats = await wireguard_peer_stats(config.stem)
+        if stats is None:
+            return None
+
+        previous = self.counters.get(config.stem)
+        # Counters moved since the last check: the traffic may have stopped up to an
+        # interval ago, and the handshake is only renewed while it flows
+        max_age = self.max_handshake_age + self.interval
+        traffic = previous is not None and previous != (stats["rx_bytes"], stats["tx_bytes"])
+
+        healthy = None
+        throughput = None
+        if self.probe_url:
+            started = time.monotonic()
+            try:
+                await asyncio.to_thread(self._fetch)
+            except OSError:
+                healthy = False
+            else:
+                after = await wireguard_peer_stats(config.stem)
+                if after:
+                    throughput = (after["rx_bytes"] - stats["rx_bytes"]) / (time.monotonic() - started)
+                    stats = after
+                    max_age = self.max_handshake_age
+                    traffic = True
+
+        if healthy is None and traffic:
+            handshake = stats["latest_handshake"]
+            if handshake:
+                healthy = time.time() - handshake <= max_age
+            elif tunnels.up_at and time.time() - tunnels.up_at > self.max_handshake_age:
+                # Traffic went out but the peer never answered
+                healthy = False
+            if healthy and throughput is not None:
+                healthy = throughput >= self.min_throughput
+        self.counters[config.stem] = (stats["rx_bytes"], stats["tx_bytes"])
+
+        # The tunnel may have been switched while we waited
+        if healthy is not None and tunnels.config == config:
+            endpoint_stats.record_health(config, healthy, throughput)
+        return healthy
+
+    def _fetch(self):
+        with urllib.request.urlopen(self.probe_url, timeout=15) as response:
+            response.read(256 * 1024)
+
+
+# Global health prober instance
+health_prober = HealthProber()
+
+
+# Domain suffixes whose sites are geo-locked to a country (ISO 3166-1 alpha-2 code).
+# Country-code TLDs are listed alongside specific broadcasters; the longest matching
+# suffix wins, so e.g. abc.com (US) and abc.net.au (AU) don't collide.
+COUNTRY_DOMAINS: dict[str, list[str]] = {
+    "gb": ["uk", "bbc.co.uk", "itv.com", "channel4.com", "channel5.com"],
+    "us": ["us", "hulu.com", "nbc.com", "abc.com", "cbs.com", "fox.com", "hbo.com", "peacocktv.com"],
+    "ca": ["ca", "cbc.ca", "ctv.ca", "globaltv.com"],
+    "au": ["au", "abc.net.au", "sbs.com.au", "9now.com.au", "10play.com.au", "7plus.com.au"],
+    "nz": ["nz"],
+    "de": ["de"],
+    "fr": ["fr"],
+    "it": ["it"],
+    "es": ["es"],
+    "nl": ["nl"],
+    "se": ["se"],
+    "no": ["no"],
+    "dk": ["dk"],
+    "jp": ["jp"],
+    "kr": ["kr"],
+    "sg": ["sg"],
+    "hk": ["hk"],
+}
+
+
+class CountryIndex:
+    """
+    Maps hostnames to country codes by their longest matching domain suffix.
+
+    Domains are stored in a trie keyed on labels from the TLD inwards, so a lookup
+    is one dict probe per label (bounded by the longest rule) with no string building.
+    """
+
+    # Trie key holding a node's country; can't clash with a DNS label
+    COUNTRY = ""
+
+    def __init__(self, rules: dict[str, list[str]]):
+        self.trie: dict = {}
+        self.max_labels = 0
+        for country, domains in rules.items():
+            for domain in domains:
+                labels = domain.lower().strip(".").split(".")
+                node = self.trie
+                for label in reversed(labels):
+                    node = node.setdefault(label, {})
+                node[self.COUNTRY] = country
+                self.max_labels = max(self.max_labels, len(labels))
+
+    def lookup(self, host: str) -> Optional[str]:
+        country = None
+        node = self.trie
+        for label in reversed(host.rstrip(".").rsplit(".", self.max_labels)):
+            node = node.get(label)
+            if node is None:
+                break
+            country = node.get(self.COUNTRY, country)
+        return country
+
+
+country_index = CountryIndex(COUNTRY_DOMAINS)
+
+
+def load_country_rules(path: Path) -> dict[str, list[str]]:
+    """
+    Read extra country rules from a TOML or JSON file mapping country codes to
+    domain suffixes, e.g. `gb = ["bbc.co.uk", "uktvplay.co.uk"]`.
+    Raises ValueError if the file is malformed.
+    """
+    text = path.read_text()
+    if path.suffix == ".toml":
+        if tomllib is None:
+            raise ValueError("TOML rule files need Python 3.11+; use JSON instead")
+        rules = tomllib.loads(text)
+    else:
+        rules = json.loads(text)
+
+    if not isinstance(rules, dict) or not all(
+        isinstance(country, str) and isinstance(domains, list) and all(isinstance(d, str) for d in domains)
+        for country, domains in rules.items()
+    ):
+        raise ValueError(f"{path}: expected a mapping of country code to a list of domains")
+    return rules
+
+
+class CountryRulesFile:
+    """
+    Compiles a rules file on top of COUNTRY_DOMAINS into the global country_index,
+    and recompiles it whenever the file's mtime changes. The new index is swapped
+    in with a single assignment, so detect_url_country never takes a lock.
+    """
+
+    def __init__(self, path: Path, interval: float = 5.0):
+        self.path = path
+        self.interval = interval
+        self.mtime: Optional[float] = None
+        # Last error reported, so a missing or bad file is reported once rather than every poll
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start polling the file (called once the event loop is running)."""
+        self.task = asyncio.create_task(self._watch())
+
+    def load(self) -> bool:
+        """Recompile the index if the file changed. A bad file keeps the current rules."""
+        global country_index
+        try:
+            mtime = self.path.stat().st_mtime
+            if mtime == self.mtime:
+                return False
+            self.mtime = mtime
+            extra = load_country_rules(self.path)
+        except (OSError, ValueError) as e:
+            if isinstance(e, OSError):
+                # Load it again once it's back, whatever its mtime
+                self.mtime = None
+            if str(e) != self.error:
+                print(f"Keeping current country rules: {e}", file=sys.stderr)
+                self.error = str(e)
+            return False
+        self.error = None
+
+        rules = {country: list(domains) for country, domains in COUNTRY_DOMAINS.items()}
+        for country, domains in extra.items():
+            rules.setdefault(country.lower(), []).extend(domains)
+        country_index = CountryIndex(rules)
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.load():
+                print(f"Reloaded country rules from {self.path}", file=sys.stderr)
+
+
 def detect_url_country(url: str) -> Optional[str]:
     """
-    Detect the target country from URL using heuristics.
-    Returns ISO 3166-1 alpha-2 country code or None.
-    """
-    url_lower = url.lower()
-    parsed = urlparse(url)
-    domain = parsed.netloc.lower()
-
-    # UK domains and services
-    if any(x in domain for x in ["bbc.co.uk", "iplayer", "itv.com", "channel4.com", "channel5.com"]):
-        return "gb"
-    if ".uk" in domain or "britain" in url_lower or "british" in url_lower:
-        return "gb"
-
-    # US domains and services
-    if any(x in domain for x in ["hulu.com", "nbc.com", "abc.com", "cbs.com", "fox.com", "hbo.com", "peacocktv.com"]):
-        return "us"
-    if ".us" in domain:
-        return "us"
-
-    # Canadian domains and services
-    if any(x in domain for x in ["cbc.ca", "ctv.ca", "globaltv.com"]):
-        return "ca"
-    if ".ca" in domain or "canada" in url_lower or "canadian" in url_lower:
-        return "ca"
-
-    # Australian domains and services
-    if any(x in domain for x in ["abc.net.au", "sbs.com.au", "9now.com.au", "10play.com.au", "7plus.com.au"]):
-        return "au"
-    if ".au" in domain or "australia" in url_lower:
-        return "au"
-
-    # New Zealand
-    if ".nz" in domain or "newzealand" in url_lower:
-        return "nz"
-
-    # European countries
-    if ".de" in domain or "germany" in url_lower or "deutsche" in url_lower:
-        return "de"
-    if ".fr" in domain or "france" in url_lower:
-        return "fr"
-    if ".it" in domain or "italy" in url_lower or "italia" in url_lower:
-        return "it"
-    if ".es" in domain or "spain" in url_lower or "españa" in url_lower:
-        return "es"
-    if ".nl" in domain or "netherlands" in url_lower:
-        return "nl"
-    if ".se" in domain or "sweden" in url_lower:
-        return "se"
-    if ".no" in domain or "norway" in url_lower:
-        return "no"
-    if ".dk" in domain or "denmark" in url_lower:
-        return "dk"
-
-    # Asian countries
-    if ".jp" in domain or "japan" in url_lower:
-        return "jp"
-    if ".kr" in domain or "korea" in url_lower:
-        return "kr"
-    if ".sg" in domain or "singapore" in url_lower:
-        return "sg"
-    if ".hk" in domain or "hongkong" in url_lower:
-        return "hk"
-
-    # YouTube and other generic platforms - no VPN by default (or use local)
-    if "youtube.com" in domain or "youtu.be" in domain:
-        return None  # Let it default to no VPN or user's location
-
-    # Default: no VPN (direct connection)
+    Detect the target country from the URL's hostname (see COUNTRY_DOMAINS).
+    Returns ISO 3166-1 alpha-2 country code, or None for a direct connection
+    (YouTube and other generic platforms).
+    """
+    host = urlsplit(url).hostname
+    if not host:
+        return None
+    return country_index.lookup(host)
+
+
+# URL paths that list many videos (playlists, channels, series) rather than one
+PLAYLIST_PATH_PATTERN = re.compile(
+    r"^/playlist/?$|^/(?:channel|c|user)/|^/@[^/]+(?:/(?:videos|streams|shorts|featured))?/?$|"
+    r"/episodes/|/series/|/sets/|/album/",
+    re.IGNORECASE
+)
+
+
+def looks_like_playlist(url: str) -> bool:
+    """Whether a URL probably lists many videos, so queue_download should expand it."""
+    parts = urlsplit(url)
+    query = parse_qs(parts.query)
+    if "list" in query and "v" not in query:
+        return True
+    return bool(PLAYLIST_PATH_PATTERN.search(parts.path))
+
+
+# Query parameters that only say where a link was shared from
+TRACKING_PARAMS = {"feature", "si", "ref", "ref_src", "fbclid", "gclid", "igshid"}
+
+
+def canonical_url(url: str) -> str:
+    """
+    URL with the variations that don't change the video removed, for spotting
+    duplicates: scheme, host case and "www.", fragment, tracking parameters and
+    query order.
+    """
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or "").removeprefix("www.")
+    if parts.port:
+        host += f":{parts.port}"
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and not key.startswith("utm_")
+    )
+    return urlunsplit(("https", host, parts.path.rstrip("/") or "/", urlencode(query), ""))
+
+
+@lru_cache(maxsize=1)
+def _archive_extractors() -> list:
+    try:
+        from yt_dlp.extractor import gen_extractor_classes
+    except ImportError:
+        return []
+    # The generic extractor matches any URL and only finds the id by downloading the page
+    return [ie for ie in gen_extractor_classes() if ie.ie_key() != "Generic"]
+
+
+@lru_cache(maxsize=4096)
+def archive_id(url: str) -> Optional[str]:
+    """
+    The video's download archive line ("<extractor> <id>"), worked out from the URL
+    the way yt-dlp checks its archive before extracting, or None if the URL doesn't
+    give it away.
+    """
+    for ie in _archive_extractors():
+        if ie.suitable(url):
+            video_id = ie.get_temp_id(url)
+            return f"{ie.ie_key().lower()} {video_id}" if video_id else None
     return None
 
 
 def get_configs_by_country() -> dict[str, list[Path]]:
     """Group all WireGuard configs by country code."""
-    configs = get_available_configs()
-    by_country = {}
-
-    for config in configs:
-        location = parse_config_location(config)
-        country = location.get("country")
-        if country:
-            if country not in by_country:
-                by_country[country] = []
-            by_country[country].append(config)
-
-    return by_country
+    return config_inventory.refresh().by_country
 
 
-def select_best_config(country: Optional[str] = None, preferred_city: Optional[str] = None) -> Optional[Path]:
+def select_best_config(country: Optional[str] = None, preferred_city: Optional[str] = None,
+                       exclude: Collection[str] = ()) -> Optional[Path]:
     """
-    Select the best WireGuard config based on country and optional city preference.
+    Select the best WireGuard config based on country and optional city preference,
+    using the measured performance of each config (see EndpointStats). A config whose
+    tunnel is already up or lingering is kept unless it is degraded. Configs named in
+    `exclude` (ones a job already failed through) are only used if nothing else fits.
     Returns None if no suitable config found or if country is None (direct connection).
     """
     if country is None:
         return None
 
-    configs = get_available_configs()
+    inventory = config_inventory.refresh()
+    # Tunnels already up (or lingering) are reused rather than switching endpoints
+    live = [tunnels.config] if tunnels.config else []
+    if namespace_tunnels:
+        live += [tunnel.config for tunnel in namespace_tunnels.tunnels.values()]
 
-    # Filter by country
-    country_configs = []
-    for config in configs:
-        location = parse_config_location(config)
-        if location.get("country") == country:
-            country_configs.append((config, location))
+    # If preferred city specified, try to match
+    city_configs = [c for c in inventory.by_city.get((country, preferred_city), []) if c.stem not in exclude]
+    if city_configs:
+        return endpoint_stats.choose(city_configs, live)
 
+    # Otherwise pick among the whole country
+    country_configs = inventory.by_country.get(country)
     if not country_configs:
         return None
-
-    # If preferred city specified, try to match
-    if preferred_city:
-        for config, location in country_configs:
-            if location.get("city") == preferred_city:
-                return config
-
-    # Otherwise return first available
-    return country_configs[0][0]
+    return endpoint_stats.choose([c for c in country_configs if c.stem not in exclude] or country_configs, live)
 
 
 @mcp.tool()
-def list_wireguard_configs() -> str:
+async def list_wireguard_configs() -> str:
     """List all available WireGuard configurations grouped by country."""
-    by_country = get_configs_by_country()
+    inventory = config_inventory.refresh()
+    by_country = inventory.by_country
 
     if not by_country:
         return "No WireGuard configs found in /etc/wireguard"
 
-    active = get_active_wireguard()
+    active = await get_active_wireguard()
 
     lines = ["Available WireGuard configurations by country:"]
     for country in sorted(by_country.keys()):
         lines.append(f"\n{country.upper()}:")
         for config in by_country[country]:
-            location = parse_config_location(config)
+            location = inventory.locations[config]
             status = " (ACTIVE)" if active and active == config.stem else ""
-            lines.append(f"  - {config.stem}{status} [{location.get('city', '?')}]")
+            line = f"  - {config.stem}{status} [{location.get('city', '?')}]"
+            stat = endpoint_stats.stats.get(config.stem)
+            if stat and stat.throughput:
+                line += f" {format_bytes(stat.throughput)}/s, {stat.failure_rate:.0%} failures"
+            if endpoint_stats.is_degraded(config):
+                line += " (DEGRADED)"
+            lines.append(line)
 
     return "\n".join(lines)
 
 
 @mcp.tool()
-def wireguard_status() -> str:
+async def wireguard_status() -> str:
     """Check current WireGuard VPN status."""
-    active = get_active_wireguard()
+    active = await get_active_wireguard()
     if active:
-        return f"WireGuard interface '{active}' is currently active"
-    return "No WireGuard interface is currently active"
+        status = f"WireGuard interface '{active}' is currently active"
+    else:
+        status = "No WireGuard interface is currently active"
+    if namespace_tunnels and namespace_tunnels.tunnels:
+        status += "\n\nNamespace tunnels:"
+        for tunnel in namespace_tunnels.tunnels.values():
+            status += f"\n  {tunnel.name} in {tunnel.namespace} ({tunnel.leases} active download(s))"
+    return status
 
 
 @mcp.tool()
-def start_wireguard(config_name: Optional[str] = None, country: Optional[str] = None, city: Optional[str] = None) -> str:
+async def start_wireguard(config_name: Optional[str] = None, country: Optional[str] = None, city: Optional[str] = None) -> str:
     """
     Start a WireGuard VPN connection.
 
@@ -379,9 +2631,9 @@ def start_wireguard(config_name: Optional[str] = None, country: Optional[str] =
         country: Country code (e.g., 'gb', 'us', 'ca'), or None for any
         city: Preferred city code (e.g., 'lon', 'nyc', 'tor'), or None for any
     """
-    # Check if already active
-    active = get_active_wireguard()
-    if active:
+    # Check if already active (an idle interface lingering after a download can be replaced)
+    active = await get_active_wireguard()
+    if active and (active != tunnels.interface or tunnels.pinned):
         return f"WireGuard interface '{active}' is already active. Stop it first."
 
     # Select config
@@ -398,99 +2650,241 @@ def start_wireguard(config_name: Optional[str] = None, country: Optional[str] =
             return msg
 
     # Start VPN
-    success, message = wireguard_up(config_path)
+    success, message = await tunnels.pin(config_path)
     return message
 
 
 @mcp.tool()
-def stop_wireguard() -> str:
+async def stop_wireguard() -> str:
     """Stop the currently active WireGuard VPN connection."""
-    active = get_active_wireguard()
+    active = await get_active_wireguard()
     if not active:
         return "No WireGuard interface is currently active"
 
-    success, message = wireguard_down(active)
+    if active == tunnels.interface:
+        success, message = await tunnels.unpin()
+    else:
+        success, message = await wireguard_down(active)
     return message
 
 
-def _download_video_internal(
+async def _download_video_internal(
     url: str,
     auto_vpn: bool = True,
     preferred_city: Optional[str] = None,
     output_dir: Optional[str] = None,
-    format_spec: str = "best"
+    format_spec: str = "best",
+    on_progress: Optional[Callable[[dict], None]] = None,
+    resume: bool = False,
+    exclude_configs: Collection[str] = (),
+    download_archive: Optional[Path] = None,
+    rate_limit: Optional[float] = None,
+    stop_after: Optional[float] = None
 ) -> str:
-    """Internal function to perform actual download (used by both direct calls and queue)."""
+    """
+    Internal function to perform actual download (used by both direct calls and queue).
+    on_progress receives parsed progress fields (see parse_progress_line) as yt-dlp reports them.
+    With `resume` yt-dlp continues a previous attempt's partial file. exclude_configs are
+    passed to select_best_config. download_archive is handed to yt-dlp (see DownloadArchive).
+    rate_limit caps the download in bytes/s; after stop_after seconds it is stopped with
+    DownloadInterrupted of kind "schedule", so it can continue at another rate. Raises
+    DownloadFailed if the download fails, or its subclass DownloadInterrupted if it was
+    stopped after yt-dlp started writing a partial file.
+    """
     output_path = Path(output_dir) if output_dir else DEFAULT_DOWNLOAD_DIR
     output_path.mkdir(parents=True, exist_ok=True)
 
-    vpn_started = False
-    original_vpn = get_active_wireguard()
+    leased = False
+    netns = None
+    vpn_config = None
+    part_file = None
+    original_vpn = await get_active_wireguard()
+    if original_vpn and original_vpn == tunnels.interface and not tunnels.pinned:
+        # Our own interface lingering after a previous job, not one the user started
+        original_vpn = None
 
     try:
         # Handle VPN if requested
-        if auto_vpn and not original_vpn:
-            country = detect_url_country(url)
-
+        country = detect_url_country(url) if auto_vpn else None
+        if namespace_tunnels and country:
+            # The tunnel lives in its own namespace, so the host's routing is left alone
+            config = select_best_config(country=country, preferred_city=preferred_city, exclude=exclude_configs)
+            if config:
+                netns, msg = await namespace_tunnels.acquire(config, exclude=exclude_configs)
+                if netns:
+                    vpn_msg = f"Using VPN: {netns.name} in namespace {netns.namespace} (detected country: {country})"
+                else:
+                    vpn_msg = f"VPN start failed: {msg}"
+            else:
+                vpn_msg = f"No VPN config found for {country}, proceeding without VPN"
+        elif auto_vpn and not original_vpn:
             if country:
-                config = select_best_config(country=country, preferred_city=preferred_city)
+                config = select_best_config(country=country, preferred_city=preferred_city,
+                                            exclude=exclude_configs)
 
                 if config:
-                    success, msg = wireguard_up(config)
+                    success, msg = await tunnels.acquire(config, exclude=exclude_configs)
                     if success:
-                        vpn_started = True
-                        vpn_msg = f"Started VPN: {config.stem} (detected country: {country})"
+                        leased = True
+                        vpn_msg = f"Using VPN: {tunnels.interface} (detected country: {country})"
                     else:
                         vpn_msg = f"VPN start failed: {msg}"
                 else:
+                    await tunnels.drop_idle()
                     vpn_msg = f"No VPN config found for {country}, proceeding without VPN"
             else:
+                await tunnels.drop_idle()
                 vpn_msg = "No VPN needed for this URL (generic/YouTube)"
         else:
+            if not original_vpn:
+                await tunnels.drop_idle()
             vpn_msg = f"Using existing VPN: {original_vpn}" if original_vpn else "Proceeding without VPN"
 
-        # Run yt-dlp
-        cmd = [
-            "yt-dlp",
-            "-f", format_spec,
-            "-o", str(output_path / "%(title)s.%(ext)s"),
-            url
-        ]
-
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=600  # 10 minute timeout
-        )
-
-        if result.returncode == 0:
-            return f"{vpn_msg}\n\nDownload successful!\n{result.stdout}"
+        # Run yt-dlp, reusing info from get_video_info if it was extracted over the same route
+        if netns:
+            route = netns.name
+            # netns-veth namespaces exit via the host's route; don't rate the config by them
+            vpn_config = netns.config if namespace_tunnels.wireguard else None
+            prefix = namespace_tunnels.exec_prefix(netns)
         else:
-            return f"{vpn_msg}\n\nDownload failed:\n{result.stderr}"
+            route = tunnels.interface if leased else original_vpn
+            vpn_config = tunnels.config if leased else None
+            prefix = ()
+        info_file = metadata_cache.info_file(url, route)
+        output_template = str(output_path / "%(title)s.%(ext)s")
+
+        # Bound each attempt by progress rather than a fixed time (see DownloadWatchdog).
+        # The size doesn't depend on the route, so info extracted directly will do.
+        expected_bytes = expected_filesize(metadata_cache.get(url, route) or metadata_cache.get(url, None))
+        expected_speed = endpoint_stats.expected_throughput(vpn_config) if vpn_config else None
+        if rate_limit:
+            expected_speed = min(expected_speed or rate_limit, rate_limit)
+        window_end = time.monotonic() + stop_after if stop_after is not None else None
+        watchdog = None
+
+        def watch() -> DownloadWatchdog:
+            nonlocal watchdog
+            watchdog = watchdog_policy.watch(expected_bytes, expected_speed, window_end)
+            return watchdog
+
+        # Average the reported speeds to rate the endpoint once the download finishes
+        average_speed = None
+        speed_samples = 0
+
+        def track_progress(progress: dict):
+            nonlocal part_file, average_speed, speed_samples
+            if progress.get("speed"):
+                speed_samples += 1
+                average_speed = (average_speed or 0.0) + (progress["speed"] - (average_speed or 0.0)) / speed_samples
+            part_file = progress.get("part_file") or part_file
+            if on_progress:
+                on_progress(progress)
 
-    except subprocess.TimeoutExpired:
-        return f"{vpn_msg}\n\nDownload timed out after 10 minutes"
+        try:
+            if info_file:
+                returncode, output = await engine.download(
+                    ["--load-info-json", str(info_file)], output_template, format_spec, track_progress, watch(),
+                    prefix=prefix, resume=resume, archive=download_archive, rate_limit=rate_limit
+                )
+                if returncode != 0:
+                    # Cached format URLs may have expired; extract afresh
+                    metadata_cache.invalidate(url, route)
+            if not info_file or returncode != 0:
+                returncode, output = await engine.download(
+                    [url], output_template, format_spec, track_progress, watch(),
+                    prefix=prefix, resume=resume, archive=download_archive, rate_limit=rate_limit
+                )
+        except subprocess.TimeoutExpired:
+            if vpn_config and watchdog.reason != DownloadWatchdog.WINDOW_CHANGED:
+                endpoint_stats.record_download(vpn_config, None, success=False)
+            raise
+
+        if returncode == 0:
+            if vpn_config:
+                # A rate-limited download says nothing about the endpoint's speed
+                throughput = average_speed if not rate_limit else None
+                endpoint_stats.record_download(vpn_config, throughput, success=True)
+            return f"{vpn_msg}\n\nDownload successful!\n{output}"
+
+        kind = classify_download_error(output)
+        if vpn_config and kind in ("geo", "network"):
+            # Only count failures the endpoint may be to blame for
+            endpoint_stats.record_download(vpn_config, None, success=False)
+        error_lines = [line for line in output.splitlines() if line.startswith("ERROR:")]
+        summary = error_lines[-1][len("ERROR: "):] if error_lines else f"yt-dlp exited with status {returncode}"
+        raise DownloadFailed(f"Download failed ({kind}): {summary}", kind, vpn_config,
+                             f"{vpn_msg}\n\nDownload failed:\n{output}")
+
+    except subprocess.TimeoutExpired as e:
+        summary = f"Download stopped after {e.timeout / 60:.1f} minutes: {watchdog.reason}"
+        details = f"{vpn_msg}\n\n{summary}"
+        if watchdog.reason == DownloadWatchdog.WINDOW_CHANGED:
+            raise DownloadInterrupted(summary, "schedule", vpn_config, details)
+        if part_file:
+            raise DownloadInterrupted(f"{summary}; partial file kept", "network", vpn_config,
+                                      f"{details}; partial file kept: {part_file}")
+        raise DownloadFailed(summary, "network", vpn_config, details)
+    except DownloadFailed:
+        raise
     except Exception as e:
-        return f"{vpn_msg}\n\nError: {str(e)}"
+        raise DownloadFailed(f"Error: {e}", "unknown", vpn_config, f"{vpn_msg}\n\nError: {str(e)}")
     finally:
-        # Clean up VPN if we started it
-        if vpn_started and not original_vpn:
-            active = get_active_wireguard()
-            if active:
-                wireguard_down(active)
+        # Hand the tunnel back; it lingers briefly for the next job
+        if leased:
+            await tunnels.release()
+        if netns:
+            await namespace_tunnels.release(netns)
+
+
+def parse_deadline(value: str) -> float:
+    """
+    Epoch seconds for a deadline given as an ISO 8601 time (local time unless it has
+    an offset) or as a delay from now such as '45s', '90m', '2h' or '1d'. Raises ValueError.
+    """
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([smhd])\s*", value)
+    if match:
+        return time.time() + float(match[1]) * {"s": 1, "m": 60, "h": 3600, "d": 86400}[match[2]]
+    return datetime.fromisoformat(value.strip()).timestamp()
+
+
+def format_deadline(deadline: float) -> str:
+    text = datetime.fromtimestamp(deadline).isoformat(sep=" ", timespec="minutes")
+    return f"{text} (overdue)" if deadline < time.time() else text
+
+
+def format_progress(job: dict) -> Optional[str]:
+    """One-line summary of a job's progress fields, or None before yt-dlp reports any."""
+    if job.get("downloaded_bytes") is None:
+        return None
+
+    parts = [format_bytes(job["downloaded_bytes"])]
+    if job.get("total_bytes"):
+        percent = 100 * job["downloaded_bytes"] / job["total_bytes"]
+        parts = [f"{percent:.1f}% of {format_bytes(job['total_bytes'])}"]
+    if job.get("speed"):
+        parts.append(f"at {format_bytes(job['speed'])}/s")
+    if job.get("eta") is not None:
+        parts.append(f"ETA {job['eta']}s")
+    if job.get("fragment_index") is not None:
+        parts.append(f"(fragment {job['fragment_index']}/{job.get('fragment_count') or '?'})")
+    return " ".join(parts)
 
 
 @mcp.tool()
-def queue_download(
+async def queue_download(
     url: str,
     auto_vpn: bool = True,
     preferred_city: Optional[str] = None,
     output_dir: Optional[str] = None,
-    format_spec: str = "best"
+    format_spec: str = "best",
+    playlist: Optional[bool] = None,
+    priority: int = 0,
+    deadline: Optional[str] = None
 ) -> str:
     """
-    Add a video download to the queue. Downloads are processed sequentially.
+    Add a video download to the queue. Downloads are processed in the background
+    by the worker pool (one at a time unless the server was started with --workers).
+    A playlist is listed in the background and each entry queued as its own job.
 
     Args:
         url: Video URL to download
@@ -498,38 +2892,165 @@ def queue_download(
         preferred_city: Preferred VPN city (e.g., 'lon', 'nyc', 'tor')
         output_dir: Download directory (default: ~/Downloads)
         format_spec: yt-dlp format specification (default: 'best')
+        playlist: True to queue each entry of a playlist, False to queue the URL as one job,
+            or None to decide from the URL (default)
+        priority: Jobs with a higher priority start first (default: 0)
+        deadline: When the download is wanted by, as a time ('2026-10-18T18:00') or from
+            now ('90m', '2h'); among jobs of the same priority the earliest deadline starts first
     """
-    job = download_queue.add(url, auto_vpn, preferred_city, output_dir, format_spec)
-
-    detected_country = detect_url_country(url) if auto_vpn else None
-    country_msg = f" (detected: {detected_country})" if detected_country else ""
+    try:
+        deadline_at = parse_deadline(deadline) if deadline else None
+    except ValueError:
+        return f"Invalid deadline: {deadline!r} (use e.g. '2h' or '2026-10-18T18:00')"
+
+    if playlist or (playlist is None and looks_like_playlist(url)):
+        expansion = download_queue.expand(url, auto_vpn, preferred_city, output_dir, format_spec,
+                                          priority, deadline_at)
+        return (f"Listing playlist #{expansion.id}: each entry is queued as its own job as it is found\n"
+                f"URL: {url}\nUse 'queue_status()' to monitor progress")
+
+    added, existing = await download_queue.add_many([url], auto_vpn, preferred_city, output_dir, format_spec,
+                                                    priority, deadline_at)
+    if existing:
+        job = existing[0]
+        return f"Already in queue: Job #{job.id} ({job.status.value})\nURL: {job.url}"
+    job = added[0]
+    if job.status == DownloadStatus.COMPLETED:
+        return f"Skipped: {job.result} (Job #{job.id})\nURL: {url}"
+
+    country_msg = f" (detected: {job.country})" if job.country else ""
 
     return f"Added to queue: Job #{job.id}{country_msg}\nURL: {url}\nUse 'queue_status()' to monitor progress"
 
 
+def format_id_ranges(ids: list[int]) -> str:
+    """Compact job id list, e.g. [3, 4, 5, 9] -> '#3-5, #9'."""
+    ranges = []
+    for job_id in sorted(set(ids)):
+        if ranges and job_id == ranges[-1][1] + 1:
+            ranges[-1][1] = job_id
+        else:
+            ranges.append([job_id, job_id])
+    return ", ".join(f"#{start}" if start == end else f"#{start}-{end}" for start, end in ranges)
+
+
 @mcp.tool()
-def queue_status() -> str:
+async def queue_download_batch(
+    urls: Optional[list[str]] = None,
+    playlist_url: Optional[str] = None,
+    auto_vpn: bool = True,
+    preferred_city: Optional[str] = None,
+    output_dir: Optional[str] = None,
+    format_spec: str = "best",
+    priority: int = 0,
+    deadline: Optional[str] = None
+) -> str:
+    """
+    Add many downloads to the queue in one call: a list of URLs, and/or every entry
+    of a playlist or channel. Each URL becomes its own job, with the same options.
+
+    Args:
+        urls: Video URLs to download
+        playlist_url: Playlist URL whose entries are queued as they are listed, in the background
+        auto_vpn: Automatically select and start VPN based on each URL (default: True)
+        preferred_city: Preferred VPN city (e.g., 'lon', 'nyc', 'tor')
+        output_dir: Download directory (default: ~/Downloads)
+        format_spec: yt-dlp format specification (default: 'best')
+        priority: Jobs with a higher priority start first (default: 0)
+        deadline: When the downloads are wanted by, as for queue_download
+    """
+    all_urls = [url.strip() for url in urls or [] if url.strip()]
+    if not all_urls and not playlist_url:
+        return "No URLs to queue"
+    try:
+        deadline_at = parse_deadline(deadline) if deadline else None
+    except ValueError:
+        return f"Invalid deadline: {deadline!r} (use e.g. '2h' or '2026-10-18T18:00')"
+
+    lines = []
+    if all_urls:
+        added, existing = await download_queue.add_many(all_urls, auto_vpn, preferred_city, output_dir, format_spec,
+                                                        priority, deadline_at)
+        jobs = [job for job in added if job.status == DownloadStatus.QUEUED]
+        archived = [job for job in added if job.status == DownloadStatus.COMPLETED]
+        if jobs:
+            countries = Counter(job.country or "direct" for job in jobs)
+            summary = ", ".join(f"{country}: {count}" for country, count in countries.most_common())
+            lines.append(f"Added {len(jobs)} job(s) to queue: {format_id_ranges([job.id for job in jobs])} ({summary})")
+        if existing:
+            lines.append(f"Already in queue: {format_id_ranges([job.id for job in existing])}")
+        if archived:
+            lines.append(f"Skipped {len(archived)} already in the download archive: "
+                         f"{format_id_ranges([job.id for job in archived])}")
+    if playlist_url:
+        expansion = download_queue.expand(playlist_url, auto_vpn, preferred_city, output_dir, format_spec,
+                                          priority, deadline_at)
+        lines.append(f"Listing playlist #{expansion.id}: each entry is queued as its own job as it is found")
+    lines.append("Use 'queue_status()' to monitor progress")
+    return "\n".join(lines)
+
+
+@mcp.tool()
+async def queue_status() -> str:
     """Check the status of the download queue."""
     status = download_queue.get_status()
 
     lines = []
 
-    # Current job
-    if status["current"]:
-        job = status["current"]
-        lines.append(f"Currently downloading: Job #{job['id']}")
-        lines.append(f"  URL: {job['url']}")
-        lines.append(f"  Started: {job['started_at']}")
+    # Rate limit or pause in force, if any
+    bandwidth = status["bandwidth"]
+    if bandwidth["rate"] is not None or bandwidth["change_at"]:
+        if bandwidth["rate"] == 0:
+            rate = "paused"
+        elif bandwidth["rate"] is None:
+            rate = "unlimited"
+        else:
+            rate = f"limited to {format_bytes(bandwidth['rate'])}/s"
+        until = f" until {datetime.fromtimestamp(bandwidth['change_at']):%H:%M}" if bandwidth["change_at"] else ""
+        lines.append(f"Downloads {rate}{until}")
+        lines.append("")
+
+    # Active jobs
+    if status["active"]:
+        lines.append(f"Currently downloading ({len(status['active'])}):")
+        for job in status["active"]:
+            lines.append(f"  #{job['id']}: {job['url']}")
+            lines.append(f"    Started: {job['started_at']}")
+            progress = format_progress(job)
+            if progress:
+                lines.append(f"    Progress: {progress}")
+        lines.append("")
+
+    # Playlists still being listed, or whose listing failed
+    if status["expansions"]:
+        lines.append("Playlists:")
+        for expansion in status["expansions"]:
+            queued = format_id_ranges(expansion["job_ids"]) if expansion["job_ids"] else "none yet"
+            lines.append(f"  Playlist #{expansion['id']} ({expansion['status']}): {expansion['url']}")
+            lines.append(f"    {len(expansion['job_ids'])} entries queued: {queued}")
+            if expansion["error"]:
+                lines.append(f"    Error: {expansion['error']}")
         lines.append("")
 
     # Queued jobs
     if status["queued"]:
-        lines.append(f"Queued jobs ({len(status['queued'])}):")
+        lines.append(f"Queued jobs ({status['queued_count']}):")
         for job in status["queued"]:
             lines.append(f"  #{job['id']}: {job['url']}")
+            if job["priority"]:
+                lines.append(f"    Priority: {job['priority']}")
+            if job["deadline"]:
+                lines.append(f"    Due: {format_deadline(job['deadline'])}")
+            if job.get("part_bytes"):
+                lines.append(f"    Resuming from {format_bytes(job['part_bytes'])}")
+            if job.get("retry_at"):
+                wait = max(0, job["retry_at"] - time.time())
+                lines.append(f"    Retrying in {wait:.0f}s (attempt {job['attempts'] + 1}): {job['error']}")
+        if status["queued_count"] > len(status["queued"]):
+            lines.append(f"  ... and {status['queued_count'] - len(status['queued'])} more")
         lines.append("")
     else:
-        if not status["current"]:
+        if not status["active"]:
             lines.append("Queue is empty")
             lines.append("")
 
@@ -537,7 +3058,7 @@ def queue_status() -> str:
     if status["recent_history"]:
         lines.append(f"Recent completions (last {len(status['recent_history'])}):")
         for job in status["recent_history"]:
-            status_icon = "✓" if job['status'] == "completed" else "✗"
+            status_icon = "✓" if job['status'] == DownloadStatus.COMPLETED else "✗"
             lines.append(f"  {status_icon} #{job['id']}: {job['url']}")
             if job.get('error'):
                 lines.append(f"     Error: {job['error']}")
@@ -546,7 +3067,81 @@ def queue_status() -> str:
 
 
 @mcp.tool()
-def queue_cancel(job_id: int) -> str:
+async def queue_job_status(job_id: int) -> str:
+    """
+    Get the status of a single download job, including finished ones.
+
+    Args:
+        job_id: The job ID (from queue_download or queue_status)
+    """
+    job = download_queue.get_job(job_id)
+    if job is None:
+        return f"Job #{job_id} not found"
+
+    lines = [f"Job #{job.id}: {job.status.value}"]
+    lines.append(f"  URL: {job.url}")
+    if job.country:
+        lines.append(f"  Country: {job.country}")
+    lines.append(f"  Added: {job.added_at}")
+    if job.priority:
+        lines.append(f"  Priority: {job.priority}")
+    if job.deadline:
+        lines.append(f"  Deadline: {format_deadline(job.deadline)}")
+    if job.started_at:
+        lines.append(f"  Started: {job.started_at}")
+    if job.completed_at:
+        lines.append(f"  Finished: {job.completed_at}")
+    if job.status == DownloadStatus.DOWNLOADING:
+        progress = format_progress(asdict(job))
+        if progress:
+            lines.append(f"  Progress: {progress}")
+    if job.part_file and job.part_bytes is not None:
+        lines.append(f"  Partial file: {job.part_file} ({format_bytes(job.part_bytes)} when last interrupted)")
+    if job.resumes:
+        lines.append(f"  Resumed: {job.resumes} time(s)")
+    if job.attempts:
+        lines.append(f"  Failed attempts: {job.attempts}")
+    if job.failed_configs:
+        lines.append(f"  Avoiding configs: {', '.join(job.failed_configs)}")
+    if job.status == DownloadStatus.QUEUED and job.retry_at:
+        lines.append(f"  Next attempt in {max(0, job.retry_at - time.time()):.0f}s")
+    if job.error:
+        lines.append(f"  Error: {job.error}")
+    if job.result:
+        lines.append(f"\n{job.result}")
+
+    return "\n".join(lines)
+
+
+@mcp.tool()
+async def queue_reprioritize(job_id: int, priority: Optional[int] = None, deadline: Optional[str] = None) -> str:
+    """
+    Change the priority and/or deadline of a queued download job.
+
+    Args:
+        job_id: The job ID to change
+        priority: New priority; higher starts first
+        deadline: New deadline, as for queue_download, or 'none' to remove it
+    """
+    if priority is None and deadline is None:
+        return "Nothing to change: give a priority and/or a deadline"
+    clear_deadline = deadline is not None and deadline.strip().lower() == "none"
+    try:
+        deadline_at = parse_deadline(deadline) if deadline and not clear_deadline else None
+    except ValueError:
+        return f"Invalid deadline: {deadline!r} (use e.g. '2h', '2026-10-18T18:00' or 'none')"
+
+    job = download_queue.reprioritize(job_id, priority, deadline_at, clear_deadline)
+    if job is None:
+        return f"Job #{job_id} is not queued"
+
+    position = next(i for i, queued in enumerate(download_queue.queue, 1) if queued is job)
+    due = f", due {format_deadline(job.deadline)}" if job.deadline else ""
+    return f"Job #{job.id}: priority {job.priority}{due}; now #{position} of {len(download_queue.queue)} in the queue"
+
+
+@mcp.tool()
+async def queue_cancel(job_id: int) -> str:
     """
     Cancel a queued download job.
 
@@ -559,14 +3154,14 @@ def queue_cancel(job_id: int) -> str:
 
 
 @mcp.tool()
-def queue_clear_history() -> str:
+async def queue_clear_history() -> str:
     """Clear the download history (keeps current/queued jobs)."""
     download_queue.clear_history()
     return "Download history cleared"
 
 
 @mcp.tool()
-def get_video_info(url: str) -> str:
+async def get_video_info(url: str) -> str:
     """
     Get information about a video without downloading it.
 
@@ -574,17 +3169,13 @@ def get_video_info(url: str) -> str:
         url: Video URL to inspect
     """
     try:
-        result = subprocess.run(
-            ["yt-dlp", "--dump-json", url],
-            capture_output=True,
-            text=True,
-            check=True,
-            timeout=30
-        )
+        route = await get_active_wireguard()
+        info = metadata_cache.get(url, route)
+        if info is None:
+            info = await engine.extract_info(url, timeout=30)
+            metadata_cache.put(url, route, info)
 
-        # Parse and format key info
-        import json
-        info = json.loads(result.stdout)
+        # Format key info
 
         output = []
         output.append(f"Title: {info.get('title', 'N/A')}")
@@ -601,8 +3192,8 @@ def get_video_info(url: str) -> str:
 
         return "\n".join(output)
 
-    except subprocess.CalledProcessError as e:
-        return f"Failed to get video info:\n{e.stderr}"
+    except YtDlpError as e:
+        return f"Failed to get video info:\n{e}"
     except subprocess.TimeoutExpired:
         return "Request timed out"
     except Exception as e:
@@ -619,13 +3210,113 @@ if __name__ == "__main__":
                         help="Host to bind to for HTTP transport (default: 0.0.0.0)")
     parser.add_argument("--port", type=int, default=8000,
                         help="Port for HTTP transport (default: 8000)")
+    parser.add_argument("--schedule", choices=["fifo", "country"], default="fifo",
+                        help="Queue scheduling: strict order, or batch jobs by VPN country (default: fifo)")
+    parser.add_argument("--max-skips", type=int, default=5,
+                        help="Times a job may be passed over by country batching before it runs (default: 5)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Concurrent downloads; in host tunnel mode VPN jobs only run together on the same tunnel (default: 1)")
+    parser.add_argument("--explore", type=float, default=0.1,
+                        help="Chance of trying a random config instead of the best measured one (default: 0.1)")
+    parser.add_argument("--probe-interval", type=float, default=60.0,
+                        help="Seconds between health checks of the active tunnel (default: 60)")
+    parser.add_argument("--probe-url",
+                        help="Small file fetched through the tunnel on each health check to measure throughput")
+    parser.add_argument("--tunnel-linger", type=float, default=30.0,
+                        help="Seconds to keep an idle VPN up for the next job (default: 30)")
+    parser.add_argument("--tunnel-mode", choices=["host", "netns", "netns-veth"], default="host",
+                        help="Run VPN tunnels in the host namespace, or each in its own network namespace "
+                             "(netns-veth: namespaces without WireGuard, for testing) (default: host)")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="Attempts per job before it fails; geo and network errors fail over to "
+                             "another config of the same country (default: 3)")
+    parser.add_argument("--retry-backoff", type=float, default=30.0,
+                        help="Seconds before the first retry, doubling for each one after (default: 30)")
+    parser.add_argument("--stall-timeout", type=float, default=120.0,
+                        help="Stop a download whose byte count hasn't moved for this many seconds (default: 120)")
+    parser.add_argument("--deadline-slack", type=float, default=3.0,
+                        help="Stop a download after this many times its expected duration, from its size "
+                             "and measured throughput, but no sooner than 10 minutes (default: 3)")
+    parser.add_argument("--history-limit", type=int, default=100,
+                        help="Finished jobs kept in memory; older ones are looked up in the state db (default: 100)")
+    parser.add_argument("--engine", choices=["subprocess", "inprocess"], default="subprocess",
+                        help="Run yt-dlp as a CLI per call, or in-process in a pool of warm worker processes (default: subprocess)")
+    parser.add_argument("--metadata-ttl", type=float, default=3600,
+                        help="Seconds to cache get_video_info results for reuse; 0 disables (default: 3600)")
+    parser.add_argument("--metadata-cache-dir", type=Path, default=DEFAULT_METADATA_CACHE_DIR,
+                        help=f"Directory for cached video info shared with downloads (default: {DEFAULT_METADATA_CACHE_DIR})")
+    parser.add_argument("--no-metadata-disk-cache", action="store_true",
+                        help="Keep cached video info in memory only (downloads then re-extract)")
+    parser.add_argument("--country-rules", type=Path,
+                        help="TOML/JSON file of extra country -> domain rules, reloaded when it changes")
+    parser.add_argument("--country-rules-poll", type=float, default=5.0,
+                        help="Seconds between checks of the country rules file (default: 5)")
+    parser.add_argument("--state-db", type=Path, default=DEFAULT_STATE_DB,
+                        help=f"SQLite file the queue and endpoint statistics are persisted to (default: {DEFAULT_STATE_DB})")
+    parser.add_argument("--no-persist", action="store_true",
+                        help="Keep the queue in memory only")
+    parser.add_argument("--limit-rate", type=parse_rate, metavar="RATE",
+                        help="Total download rate, e.g. 500K or 2M (bytes/s), split between the workers "
+                             "(default: unlimited)")
+    parser.add_argument("--window", type=parse_window, action="append", default=[], metavar="HH:MM-HH:MM=RATE",
+                        help="Daily window with its own total rate (a rate, 'unlimited' or 'pause'), "
+                             "e.g. 08:00-18:00=pause; may be repeated, the first matching window applies")
+    parser.add_argument("--download-archive", type=Path, default=DEFAULT_DOWNLOAD_ARCHIVE,
+                        help=f"yt-dlp download archive of finished videos, which are not downloaded again "
+                             f"(default: {DEFAULT_DOWNLOAD_ARCHIVE})")
+    parser.add_argument("--no-download-archive", action="store_true",
+                        help="Download videos again even if they were downloaded before")
 
     args = parser.parse_args()
+    if args.limit_rate == 0:
+        parser.error("--limit-rate can't pause all downloads; use --window to pause them at times")
+
+    tunnels.linger = args.tunnel_linger
+    if args.tunnel_mode != "host":
+        namespace_tunnels = NamespaceTunnels(linger=args.tunnel_linger, wireguard=args.tunnel_mode == "netns")
+        download_queue.isolated_tunnels = True
+    download_queue.schedule = args.schedule
+    download_queue.max_skips = args.max_skips
+    download_queue.workers = max(1, args.workers)
+    download_queue.set_history_limit(max(1, args.history_limit))
+    download_queue.max_attempts = max(1, args.max_attempts)
+    download_queue.retry_backoff = args.retry_backoff
+    download_queue.bandwidth = BandwidthSchedule(args.limit_rate, args.window)
+    if args.engine == "inprocess":
+        # One process per download worker plus one for get_video_info
+        engine = InProcessEngine(processes=download_queue.workers + 1)
+    metadata_cache.ttl = args.metadata_ttl
+    watchdog_policy.stall_timeout = args.stall_timeout
+    watchdog_policy.slack = args.deadline_slack
+    metadata_cache.cache_dir = None if args.no_metadata_disk_cache else args.metadata_cache_dir
+    endpoint_stats.explore = args.explore
+    health_prober.interval = args.probe_interval
+    health_prober.probe_url = args.probe_url
+    if not args.no_download_archive:
+        download_queue.archive = DownloadArchive(args.download_archive)
+    if not args.no_persist:
+        store = JobStore(args.state_db)
+        download_queue.attach_store(store)
+        endpoint_stats.attach_store(store)
+    country_rules = None
+    if args.country_rules:
+        country_rules = CountryRulesFile(args.country_rules, interval=args.country_rules_poll)
+        country_rules.load()
+
+    async def serve():
+        # Resume any recovered jobs without waiting for a tool call
+        download_queue.start()
+        health_prober.start()
+        if country_rules:
+            country_rules.start()
+        if args.transport == "http":
+            await mcp.run_async(transport="http", host=args.host, port=args.port)
+        else:
+            await mcp.run_async()
 
     if args.transport == "http":
         print(f"Starting MCP server on http://{args.host}:{args.port}")
         print("Access from Claude Desktop using HTTP SSE transport")
-        mcp.run(transport="http", host=args.host, port=args.port)
     else:
         print("Starting MCP server with stdio transport")
-        mcp.run()
+    asyncio.run(serve())